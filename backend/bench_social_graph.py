@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Benchmark bytes read per request as the social graph grows
+Compares the auth lookup and dashboard read against the old layout with
+embedded friends/followers arrays. Writes to throwaway documents only.
+"""
+
+import asyncio
+import uuid
+from datetime import datetime
+from bson import encode
+
+from server import db, USER_PROJECTION, DASHBOARD_PROJECTION
+
+SIZES = [0, 100, 1000, 10000]
+
+async def measure(user_id: str, dashboard_id: str):
+    user = await db.users.find_one({"user_id": user_id}, USER_PROJECTION)
+    dashboard = await db.dashboards.find_one({"dashboard_id": dashboard_id}, DASHBOARD_PROJECTION)
+    return len(encode(user)), len(encode(dashboard))
+
+async def main():
+    user_id, dashboard_id = f"bench-{uuid.uuid4()}", f"bench-{uuid.uuid4()}"
+    legacy_user_id, legacy_dashboard_id = f"bench-{uuid.uuid4()}", f"bench-{uuid.uuid4()}"
+    now = datetime.utcnow()
+    user_doc = {"username": "bench", "email": "bench@example.com", "full_name": "Bench", "created_at": now}
+    dashboard_doc = {"owner_id": user_id, "title": "Bench", "is_public": True, "created_at": now, "widgets": []}
+    
+    await db.users.insert_many([
+        {**user_doc, "user_id": user_id, "friends_count": 0},
+        {**user_doc, "user_id": legacy_user_id, "friends": []}
+    ])
+    await db.dashboards.insert_many([
+        {**dashboard_doc, "dashboard_id": dashboard_id, "followers_count": 0},
+        {**dashboard_doc, "dashboard_id": legacy_dashboard_id, "followers": []}
+    ])
+    
+    print(f"{'edges':>8} {'user (edges)':>14} {'user (array)':>14} {'dash (edges)':>14} {'dash (array)':>14}")
+    try:
+        for size in SIZES:
+            members = [str(uuid.uuid4()) for _ in range(size)]
+            await db.friendships.delete_many({"user_id": user_id})
+            await db.dashboard_followers.delete_many({"dashboard_id": dashboard_id})
+            if members:
+                await db.friendships.insert_many([{"user_id": user_id, "friend_id": m, "created_at": now} for m in members])
+                await db.dashboard_followers.insert_many([{"dashboard_id": dashboard_id, "user_id": m, "created_at": now} for m in members])
+            await db.users.update_one({"user_id": user_id}, {"$set": {"friends_count": size}})
+            await db.dashboards.update_one({"dashboard_id": dashboard_id}, {"$set": {"followers_count": size}})
+            await db.users.update_one({"user_id": legacy_user_id}, {"$set": {"friends": members}})
+            await db.dashboards.update_one({"dashboard_id": legacy_dashboard_id}, {"$set": {"followers": members}})
+            
+            user_bytes, dashboard_bytes = await measure(user_id, dashboard_id)
+            legacy_user = await db.users.find_one({"user_id": legacy_user_id})
+            legacy_dashboard = await db.dashboards.find_one({"dashboard_id": legacy_dashboard_id})
+            print(f"{size:>8} {user_bytes:>14} {len(encode(legacy_user)):>14} {dashboard_bytes:>14} {len(encode(legacy_dashboard)):>14}")
+    finally:
+        await db.users.delete_many({"user_id": {"$in": [user_id, legacy_user_id]}})
+        await db.dashboards.delete_many({"dashboard_id": {"$in": [dashboard_id, legacy_dashboard_id]}})
+        await db.friendships.delete_many({"user_id": user_id})
+        await db.dashboard_followers.delete_many({"dashboard_id": dashboard_id})
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Move embedded friends/followers arrays into edge collections
+Creates friendships / dashboard_followers edges, sets friends_count /
+followers_count from the edges and unsets the arrays. Safe to re-run.
+"""
+
+import asyncio
+from datetime import datetime
+from pymongo import UpdateOne
+
+from server import db
+
+BATCH_SIZE = 500
+
+async def migrate(collection, key: str, array_field: str, edge_collection, edge_field: str, counter: str):
+    migrated = 0
+    cursor = collection.find(
+        {array_field: {"$exists": True}},
+        {"_id": 0, key: 1, array_field: 1}
+    ).batch_size(BATCH_SIZE)
+    
+    async for doc in cursor:
+        now = datetime.utcnow()
+        edges = [
+            UpdateOne(
+                {key: doc[key], edge_field: member},
+                {"$setOnInsert": {"created_at": now}},
+                upsert=True
+            )
+            for member in dict.fromkeys(doc.get(array_field) or [])
+        ]
+        for start in range(0, len(edges), BATCH_SIZE):
+            await edge_collection.bulk_write(edges[start:start + BATCH_SIZE], ordered=False)
+        
+        count = await edge_collection.count_documents({key: doc[key]})
+        await collection.update_one(
+            {key: doc[key]},
+            {"$set": {counter: count}, "$unset": {array_field: ""}}
+        )
+        migrated += 1
+    
+    return migrated
+
+async def main():
+    users = await migrate(db.users, "user_id", "friends", db.friendships, "friend_id", "friends_count")
+    print(f"Migrated friends for {users} users")
+    
+    dashboards = await migrate(db.dashboards, "dashboard_id", "followers", db.dashboard_followers, "user_id", "followers_count")
+    print(f"Migrated followers for {dashboards} dashboards")
+
+if __name__ == "__main__":
+    asyncio.run(main())
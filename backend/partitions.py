@@ -0,0 +1,96 @@
+"""
+Horizontal partitioning of the data_points collection
+Each partition is a MongoDB URL with its own Motor client pool. A point lives on
+the partition that ranks highest for its routing key (widget_id or owner_id)
+under rendezvous hashing, so adding a partition only moves the keys that now
+rank it first. A partition's name is its identity in the hash: keep names
+stable when URLs change by configuring entries as name=url.
+
+Locally, each partition can be its own mongod:
+    mongod --port 27018 --dbpath /tmp/p0 & mongod --port 27019 --dbpath /tmp/p1 &
+    DATA_PARTITION_URLS="p0=mongodb://localhost:27018 p1=mongodb://localhost:27019"
+"""
+
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+PARTITION_KEYS = ("widget_id", "owner_id")
+
+
+def rendezvous_score(name: str, key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{name}:{key}".encode(), digest_size=8).digest(), "big")
+
+
+def parse_partition_urls(value: str) -> List[tuple]:
+    # Whitespace-separated, since replica set URLs contain commas
+    entries = []
+    for entry in value.split():
+        name, sep, url = entry.partition("=")
+        if not sep or "/" in name or ":" in name:
+            name, url = entry, entry
+        entries.append((name, url))
+    return entries
+
+
+class Partition:
+    def __init__(self, name: str, collection):
+        self.name = name
+        self.collection = collection
+
+    def __repr__(self):
+        return f"Partition({self.name!r})"
+
+
+class PartitionRouter:
+    def __init__(self, partitions: List[Partition], key: str = "widget_id", local: bool = False):
+        if key not in PARTITION_KEYS:
+            raise ValueError(f"Partition key must be one of: {', '.join(PARTITION_KEYS)}")
+        if not partitions:
+            raise ValueError("At least one partition is required")
+        self.partitions = partitions
+        self.key = key
+        # A single partition on the main client can share its sessions and transactions
+        self.local = local
+
+    @classmethod
+    def from_urls(cls, urls: str, database: str, collection: str = "data_points", key: str = "widget_id"):
+        partitions = [
+            Partition(name, AsyncIOMotorClient(url)[database][collection])
+            for name, url in parse_partition_urls(urls)
+        ]
+        return cls(partitions, key)
+
+    def partition_for(self, routing_key: str) -> Partition:
+        if len(self.partitions) == 1:
+            return self.partitions[0]
+        return max(self.partitions, key=lambda p: rendezvous_score(p.name, routing_key))
+
+    def route(self, doc: Dict[str, Any]):
+        # doc is a point or a widget; both carry widget_id and owner_id
+        return self.partition_for(doc[self.key]).collection
+
+    def group(self, docs: List[Dict[str, Any]]) -> Dict[Partition, List[Dict[str, Any]]]:
+        groups = {}
+        for doc in docs:
+            groups.setdefault(self.partition_for(doc[self.key]), []).append(doc)
+        return groups
+
+    async def insert_many(self, docs: List[Dict[str, Any]], session=None):
+        await asyncio.gather(*[
+            partition.collection.insert_many(group, session=session)
+            for partition, group in self.group(docs).items()
+        ])
+
+    async def scatter(self, operation: Callable[[Any], Awaitable[Any]], partitions: Optional[List[Partition]] = None) -> List[Any]:
+        # Runs operation(collection) on every partition concurrently, results in partition order
+        return await asyncio.gather(*[operation(p.collection) for p in partitions or self.partitions])
+
+    async def scatter_for(self, docs: List[Dict[str, Any]], operation: Callable[[Any, List[Dict[str, Any]]], Awaitable[Any]]) -> List[Any]:
+        # Like scatter, but only on the partitions owning docs, each given its share
+        return await asyncio.gather(*[
+            operation(partition.collection, group)
+            for partition, group in self.group(docs).items()
+        ])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Move data points onto the partition that owns them under DATA_PARTITION_URLS
+Run after adding a partition. Partitions being removed (or the main MONGO_URL
+when partitioning is first enabled) are drained by passing their URLs with
+--drain. Reads follow the new layout at once, so run it in a quiet period.
+Each batch is copied before it is deleted at the source, so it is safe to re-run.
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from partitions import Partition, parse_partition_urls
+from server import db, data_router
+
+BATCH_SIZE = 1000
+
+async def move_key(source: Partition, target: Partition, key: str):
+    moved = 0
+    while True:
+        points = await source.collection.find({data_router.key: key}).limit(BATCH_SIZE).to_list(None)
+        if not points:
+            return moved
+        # A run that stopped between copy and delete leaves copies behind; replace them
+        await target.collection.delete_many({data_router.key: key, "data_id": {"$in": [p["data_id"] for p in points]}})
+        await target.collection.insert_many(points)
+        await source.collection.delete_many({"_id": {"$in": [p["_id"] for p in points]}})
+        moved += len(points)
+
+async def rebalance(source: Partition, dry_run: bool):
+    moved = 0
+    keys = source.collection.aggregate([{"$group": {"_id": f"${data_router.key}"}}], allowDiskUse=True)
+    async for group in keys:
+        key = group["_id"]
+        target = data_router.partition_for(key)
+        if target.name == source.name:
+            continue
+        if dry_run:
+            moved += await source.collection.count_documents({data_router.key: key})
+            continue
+        moved += await move_key(source, target, key)
+        # Cached reads taken mid-move may be missing points; a new version retires them
+        await db.widgets.update_many(
+            {data_router.key: key},
+            {"$inc": {"data_version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+    return moved
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--drain", nargs="*", default=[], help="URLs of partitions to empty into the configured ones")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the points that would move")
+    args = parser.parse_args()
+
+    drained = [
+        Partition(name, AsyncIOMotorClient(url).dashboard_platform.data_points)
+        for name, url in parse_partition_urls(" ".join(args.drain))
+    ]
+    for source in data_router.partitions + drained:
+        moved = await rebalance(source, args.dry_run)
+        print(f"{'Would move' if args.dry_run else 'Moved'} {moved} points off {source.name}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,23 +1,48 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, status
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Header, Query, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import asyncio
+import logging
+import time
+import math
 from dotenv import load_dotenv
 import uuid
 import json
+import ast
+import base64
+import operator
+from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 import jwt
 import bcrypt
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, ValidationError, field_validator
 from typing import Optional, List, Dict, Any
 import pandas as pd
+import numpy as np
 import aiofiles
+import csv
+import io
+import zlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib
+from PIL import Image, ImageColor, ImageDraw, ImageFont, features
 from pathlib import Path
+from sketches import KLLSketch, HyperLogLog
+from partitions import Partition, PartitionRouter
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Personal Dashboard Platform API", version="1.0.0")
 
 # CORS middleware
@@ -46,8 +71,74 @@ JWT_EXPIRATION_HOURS = int(os.environ.get("JWT_EXPIRATION_HOURS", 24))
 UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "uploads")
 Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
 
+# Discover feed snapshot settings
+DISCOVER_PAGE_SIZE = int(os.environ.get("DISCOVER_PAGE_SIZE", 20))
+DISCOVER_SNAPSHOT_PAGES = int(os.environ.get("DISCOVER_SNAPSHOT_PAGES", 5))
+DISCOVER_SNAPSHOT_INTERVAL = int(os.environ.get("DISCOVER_SNAPSHOT_INTERVAL", 60))
+
+# Derived metric settings
+DERIVED_CACHE_SIZE = int(os.environ.get("DERIVED_CACHE_SIZE", 512))
+
+# Batch data query settings
+BATCH_QUERY_MAX = int(os.environ.get("BATCH_QUERY_MAX", 100))
+BATCH_QUERY_CONCURRENCY = int(os.environ.get("BATCH_QUERY_CONCURRENCY", 8))
+
+# Request coalescing settings
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 10))
+
+# Write admission settings
+WRITE_RATE_PER_SECOND = float(os.environ.get("WRITE_RATE_PER_SECOND", 10))
+WRITE_BURST = float(os.environ.get("WRITE_BURST", 50))
+WRITE_MAX_IN_FLIGHT = int(os.environ.get("WRITE_MAX_IN_FLIGHT", 64))
+WRITE_UPLOAD_COST = float(os.environ.get("WRITE_UPLOAD_COST", 10))
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # memory, redis
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Delta sync settings
+SYNC_GAP_TIMEOUT = int(os.environ.get("SYNC_GAP_TIMEOUT", 30))
+
+# Retention settings
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 1000))
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", 0.1))
+
+# Sketch settings
+SKETCH_MAX_RETRIES = int(os.environ.get("SKETCH_MAX_RETRIES", 5))
+SKETCH_CONCURRENCY = int(os.environ.get("SKETCH_CONCURRENCY", 8))
+
+# Export settings
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 5000))
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+# Data point partition settings
+DATA_PARTITION_URLS = os.environ.get("DATA_PARTITION_URLS", "")
+DATA_PARTITION_KEY = os.environ.get("DATA_PARTITION_KEY", "widget_id")
+
+# data_points is routed through data_router; without DATA_PARTITION_URLS it is
+# the single collection on the main client
+if DATA_PARTITION_URLS:
+    data_router = PartitionRouter.from_urls(DATA_PARTITION_URLS, "dashboard_platform", key=DATA_PARTITION_KEY)
+else:
+    data_router = PartitionRouter([Partition("default", db.data_points)], DATA_PARTITION_KEY, local=True)
+
+# Thumbnail settings
+THUMBNAIL_FOLDER = Path(UPLOAD_FOLDER) / "thumbnails"
+THUMBNAIL_FOLDER.mkdir(parents=True, exist_ok=True)
+THUMBNAIL_INTERVAL = int(os.environ.get("THUMBNAIL_INTERVAL", 300))
+THUMBNAIL_SIZE = (480, 270)
+THUMBNAIL_POINTS = int(os.environ.get("THUMBNAIL_POINTS", 48))
+THUMBNAIL_FORMAT = "webp" if features.check("webp") else "png"
+
 # Mount static files
-app.mount("/uploads", StaticFiles(directory=UPLOAD_FOLDER), name="uploads")
+class UploadFiles(StaticFiles):
+    # Thumbnails are content-addressed, so a given URL never changes
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if Path(full_path).parent == THUMBNAIL_FOLDER.resolve():
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+app.mount("/uploads", UploadFiles(directory=UPLOAD_FOLDER), name="uploads")
 
 # Models
 class UserRegister(BaseModel):
@@ -60,12 +151,26 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class SeedDataPoint(BaseModel):
+    data: Dict[str, Any]
+    timestamp: Optional[datetime] = None
+
+class DashboardWidgetCreate(BaseModel):
+    widget_type: str  # chart, metric, progress, table
+    title: str
+    position: Optional[Dict[str, Any]] = None  # x, y, width, height
+    config: Dict[str, Any] = {}
+    data_source: Optional[Dict[str, Any]] = None
+    data: List[SeedDataPoint] = []
+
 class DashboardCreate(BaseModel):
     title: str
     description: Optional[str] = None
     template_type: str  # fitness, habits, projects, custom
     is_public: bool = False
     custom_domain: Optional[str] = None
+    widgets: List[DashboardWidgetCreate] = []
+    use_template_widgets: bool = False  # add the template's default widgets
 
 class WidgetCreate(BaseModel):
     dashboard_id: str
@@ -81,6 +186,143 @@ class DataPointCreate(BaseModel):
     data: Dict[str, Any]
     timestamp: Optional[datetime] = None
 
+class CsvWidgetMapping(BaseModel):
+    widget_id: str
+    columns: List[str] = Field(min_length=1)
+    timestamp_column: Optional[str] = None
+    timestamp_format: Optional[str] = None  # strftime format, inferred when omitted
+    
+    @field_validator("columns")
+    @classmethod
+    def unique_columns(cls, columns: List[str]):
+        duplicates = sorted({c for c in columns if columns.count(c) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicate columns: {', '.join(duplicates)}")
+        return columns
+
+class DataQuery(BaseModel):
+    widget_id: str
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    fields: Optional[List[str]] = None
+    shape: str = "rows"  # rows, columns
+    aggregate: Optional[str] = None  # sum, mean, min, max, count, last
+    interval: Optional[str] = None  # pandas offset alias, e.g. 1D, 1W
+    since: Optional[str] = None  # cursor from a previous response
+
+class RetentionSettings(BaseModel):
+    raw_days: Optional[int] = None  # keep raw points this many days, None keeps forever
+    compact: bool = True  # fold expired points into daily aggregates instead of dropping them
+
+class DataQueryBatch(BaseModel):
+    queries: List[DataQuery]
+
+# Dashboard templates: default widgets per template_type, parsed once at import
+DASHBOARD_TEMPLATES = {
+    "fitness": [
+        {"widget_type": "metric", "title": "Daily Steps", "config": {"color": "blue", "showTarget": True, "showTrend": True}},
+        {"widget_type": "metric", "title": "Calories Burned", "config": {"color": "orange", "showTarget": True}},
+        {"widget_type": "chart", "title": "Weekly Steps Trend", "config": {"type": "area", "color": "#3B82F6"}},
+        {"widget_type": "progress", "title": "Monthly Workout Goal", "config": {"type": "circular", "color": "green"}},
+        {"widget_type": "table", "title": "Recent Activities", "config": {"pageSize": 5}},
+    ],
+    "habits": [
+        {"widget_type": "progress", "title": "Meditation Streak", "config": {"type": "streak", "color": "purple"}},
+        {"widget_type": "progress", "title": "Reading Goal", "config": {"type": "linear", "color": "green"}},
+        {"widget_type": "progress", "title": "Habit Calendar", "config": {"type": "streak", "color": "blue"}},
+        {"widget_type": "metric", "title": "Today's Habits", "config": {"color": "green", "size": "large"}},
+    ],
+    "learning": [
+        {"widget_type": "metric", "title": "Books Read This Year", "config": {"color": "green", "showTarget": True}},
+        {"widget_type": "metric", "title": "Study Hours This Month", "config": {"color": "blue", "showTarget": True}},
+        {"widget_type": "progress", "title": "Course Progress", "config": {"type": "linear", "color": "purple"}},
+        {"widget_type": "table", "title": "Subject Progress", "config": {"sortable": True}},
+    ],
+    "projects": [
+        {"widget_type": "metric", "title": "Open Tasks", "config": {"color": "blue", "showTarget": True}},
+        {"widget_type": "progress", "title": "Milestone Progress", "config": {"type": "linear", "color": "green"}},
+        {"widget_type": "chart", "title": "Tasks Completed", "config": {"type": "line", "color": "#10B981"}},
+        {"widget_type": "table", "title": "Project Status", "config": {"sortable": True}},
+    ],
+}
+DASHBOARD_TEMPLATES = {
+    template_type: [DashboardWidgetCreate(**widget) for widget in widgets]
+    for template_type, widgets in DASHBOARD_TEMPLATES.items()
+}
+
+# Hot-path projections: keep auth and dashboard reads to fixed-size fields
+USER_PROJECTION = {"_id": 0, "user_id": 1, "username": 1, "email": 1, "full_name": 1, "created_at": 1, "friends_count": 1}
+DASHBOARD_PROJECTION = {"_id": 0, "followers": 0}
+WIDGET_PROJECTION = {"_id": 0}
+
+# Request-scoped loaders: lookups by key issued in the same event-loop tick are
+# batched into one $in query per collection and memoized for the request
+class DataLoader:
+    def __init__(self, collection, key: str, projection: Dict[str, Any]):
+        self.collection = collection
+        self.key = key
+        self.projection = projection
+        self.cache = {}
+        self.queue = {}
+        # asyncio keeps only weak references to tasks, so in-flight batches are held here
+        self.tasks = set()
+    
+    def load(self, key: str):
+        if key in self.cache:
+            return self.cache[key]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.cache[key] = future
+        self.queue[key] = future
+        if len(self.queue) == 1:
+            loop.call_soon(self._schedule)
+        return future
+    
+    def _schedule(self):
+        task = asyncio.ensure_future(self._dispatch())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def load_many(self, keys: List[str]):
+        return await asyncio.gather(*(self.load(key) for key in keys))
+    
+    async def _dispatch(self):
+        batch, self.queue = self.queue, {}
+        try:
+            docs = await self.collection.find({self.key: {"$in": list(batch)}}, self.projection).to_list(None)
+        except Exception as e:
+            for key, future in batch.items():
+                self.cache.pop(key, None)
+                if not future.done():
+                    future.set_exception(e)
+                    # Waiters still see the error; callers that have gone away do not log it
+                    future.exception()
+            return
+        found = {doc[self.key]: doc for doc in docs}
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+class Loaders:
+    def __init__(self):
+        self.users = DataLoader(db.users, "user_id", USER_PROJECTION)
+        self.dashboards = DataLoader(db.dashboards, "dashboard_id", DASHBOARD_PROJECTION)
+        self.widgets = DataLoader(db.widgets, "widget_id", WIDGET_PROJECTION)
+
+request_loaders = ContextVar("request_loaders", default=None)
+
+def get_loaders() -> Loaders:
+    # Outside a request (background tasks) every call gets a fresh, unshared set
+    return request_loaders.get() or Loaders()
+
+@app.middleware("http")
+async def loaders_middleware(request: Request, call_next):
+    token = request_loaders.set(Loaders())
+    try:
+        return await call_next(request)
+    finally:
+        request_loaders.reset(token)
+
 # Helper functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -100,7 +342,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = await db.users.find_one({"user_id": user_id})
+        user = await get_loaders().users.load(user_id)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         
@@ -108,11 +350,1131 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def build_data_query(
+    widget_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    since: Optional[tuple] = None
+):
+    query = {"widget_id": widget_id}
+    if start or end:
+        query["timestamp"] = {}
+        if start:
+            query["timestamp"]["$gte"] = start
+        if end:
+            query["timestamp"]["$lt"] = end
+    if since:
+        query["seq"] = {"$gt": since}
+    return query
+
+# Sync cursors are per-widget sequence numbers. Writers reserve a dense range with
+# $inc on the widget before inserting, so a missing seq below the newest one seen
+# is a write still in flight and the cursor stops short of it
+async def reserve_seq(widget_id: str, count: int):
+    widget = await db.widgets.find_one_and_update(
+        {"widget_id": widget_id},
+        {"$inc": {"seq": count}},
+        projection={"_id": 0, "widget_id": 1, "seq": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if widget is None:
+        raise ValueError(f"Widget not found: {widget_id}")
+    return widget["seq"] - count + 1
+
+async def assign_seq(widget_id: str, points: List[Dict[str, Any]]):
+    first = await reserve_seq(widget_id, len(points))
+    for offset, point in enumerate(points):
+        point["seq"] = first + offset
+
+def encode_cursor(seq: int):
+    return base64.urlsafe_b64encode(str(seq).encode()).decode()
+
+def decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+def sync_watermark(entries: List[tuple], base: int):
+    # A gap whose next point is older than SYNC_GAP_TIMEOUT will never fill
+    # (failed insert or retention), so it no longer holds the cursor back
+    horizon = datetime.utcnow() - timedelta(seconds=SYNC_GAP_TIMEOUT)
+    watermark = base
+    for seq, created_at in sorted(entries):
+        if seq != watermark + 1 and created_at > horizon:
+            break
+        watermark = seq
+    return watermark
+
+async def sync_cursor(
+    widget: Dict[str, Any],
+    points: List[Dict[str, Any]],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    since: Optional[str] = None
+):
+    base = decode_cursor(since) or 0
+    if start or end:
+        # Points outside the range would look like gaps, so check the full sequence
+        entries = await data_router.route(widget).find(
+            {"widget_id": widget["widget_id"], "seq": {"$gt": base}},
+            {"_id": 0, "seq": 1, "created_at": 1}
+        ).to_list(None)
+    else:
+        entries = points
+    entries = [(p["seq"], p["created_at"]) for p in entries if "seq" in p]
+    if not entries:
+        return since, points
+    watermark = sync_watermark(entries, base)
+    if since:
+        # Held back until the gap fills, so a sync never skips or repeats a point
+        points = [p for p in points if p.get("seq", 0) <= watermark]
+    return encode_cursor(watermark) if watermark else since, points
+
+def data_etag(widget: Dict[str, Any]):
+    return f'W/"{widget["widget_id"]}:{widget.get("data_version", 0)}"'
+
+def parse_fields(fields: Optional[str]):
+    if not fields:
+        return None
+    return validate_fields(fields.split(","))
+
+def validate_fields(fields: Optional[List[str]]):
+    field_list = [f.strip() for f in fields or [] if f.strip()]
+    if any(f.startswith("$") for f in field_list):
+        raise HTTPException(status_code=400, detail="Invalid field name")
+    return field_list or None
+
+def data_projection(field_list: Optional[List[str]]):
+    if not field_list:
+        return {"_id": 0}
+    projection = {"_id": 0, "timestamp": 1, "created_at": 1, "data_id": 1, "seq": 1}
+    projection.update({f"data.{f}": 1 for f in field_list})
+    return projection
+
+def to_columns(points: List[Dict[str, Any]], field_list: Optional[List[str]] = None):
+    rows = [p.get("data", {}) for p in points]
+    keys = field_list or list(dict.fromkeys(k for row in rows for k in row))
+    columns = {"timestamp": [p["timestamp"].isoformat() for p in points]}
+    for key in keys:
+        columns[key] = [row.get(key) for row in rows]
+    return columns
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def aggregate_points(points: List[Dict[str, Any]], field_list: Optional[List[str]], how: str, interval: Optional[str] = None):
+    if how not in DERIVED_REDUCERS:
+        raise ValueError(f"Unknown aggregate: {how}")
+    if not points:
+        return {"timestamp": []} if interval else {}
+    index = pd.DatetimeIndex([p["timestamp"] for p in points])
+    compacted = np.array([bool(p.get("compacted")) for p in points])
+    
+    # Compacted days aggregate from their stored sum/counts/min/max, raw points
+    # from their values, so sum and count stay exact across the boundary
+    def stat_frame(stat: str):
+        records = [p["stats"].get(stat, {}) if c else p.get("data", {}) for p, c in zip(points, compacted)]
+        return pd.DataFrame.from_records(records, index=index).reindex(columns=frame.columns).apply(pd.to_numeric, errors="coerce")
+    
+    frame = pd.DataFrame.from_records([p.get("data", {}) for p in points], index=index)
+    if field_list:
+        frame = frame.reindex(columns=field_list)
+    frame = frame.apply(pd.to_numeric, errors="coerce").dropna(axis=1, how="all")
+    counts = frame.notna().astype("int64")
+    if compacted.any():
+        counts.loc[compacted] = stat_frame("counts").loc[compacted].fillna(0).astype("int64").values
+    sums, minimums, maximums = (stat_frame(stat) if compacted.any() else frame for stat in ("sum", "min", "max"))
+    
+    if not interval:
+        reduce = {
+            "sum": lambda: sums.sum(),
+            "count": lambda: counts.sum(),
+            "mean": lambda: sums.sum() / counts.sum().replace(0, np.nan),
+            "min": lambda: minimums.min(),
+            "max": lambda: maximums.max(),
+            "last": lambda: frame.apply(DERIVED_REDUCERS["last"]),
+        }[how]()
+        return {field: to_json_scalar(reduce[field]) for field in frame.columns}
+    buckets = {
+        "sum": lambda: sums.resample(interval).sum(),
+        "count": lambda: counts.resample(interval).sum(),
+        "mean": lambda: sums.resample(interval).sum() / counts.resample(interval).sum().replace(0, np.nan),
+        "min": lambda: minimums.resample(interval).min(),
+        "max": lambda: maximums.resample(interval).max(),
+        "last": lambda: frame.resample(interval).last(),
+    }[how]()
+    columns = {"timestamp": [ts.isoformat() for ts in buckets.index]}
+    for field in buckets.columns:
+        columns[field] = to_json_values(buckets[field])
+    return columns
+
+# Compacted days read back as one mean-valued point per day, with the day's
+# per-field sum/counts/min/max under "stats" for exact aggregation
+def compacted_means(day: Dict[str, Any]):
+    counts = day.get("counts", {})
+    return {key: total / counts[key] for key, total in day.get("sum", {}).items() if counts.get(key)}
+
+COMPACTED_STATS = ("sum", "counts", "min", "max")
+
+async def fetch_compacted(widget_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None, field_list: Optional[List[str]] = None):
+    query = {"widget_id": widget_id}
+    if start or end:
+        query["day"] = {}
+        if start:
+            query["day"]["$gte"] = day_start(start)
+        if end:
+            query["day"]["$lt"] = end
+    projection = {"_id": 0, "day": 1, "count": 1}
+    if field_list:
+        projection.update({f"{part}.{f}": 1 for part in COMPACTED_STATS for f in field_list})
+    else:
+        projection.update({part: 1 for part in COMPACTED_STATS})
+    days = await db.data_daily.find(query, projection).sort("day", 1).to_list(None)
+    return [{
+        "timestamp": d["day"],
+        "data": compacted_means(d),
+        "count": d["count"],
+        "stats": {part: d.get(part, {}) for part in COMPACTED_STATS},
+        "compacted": True
+    } for d in days]
+
+async def fetch_points(
+    widget: Dict[str, Any],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    field_list: Optional[List[str]] = None,
+    since: Optional[str] = None
+):
+    widget_id = widget["widget_id"]
+    raw_query = data_router.route(widget).find(
+        build_data_query(widget_id, start, end, decode_cursor(since)),
+        data_projection(field_list)
+    ).sort("timestamp", 1).to_list(None)
+    if since:
+        # Cursors only cover raw points; compacted days are never new
+        return await raw_query
+    compacted, raw = await asyncio.gather(fetch_compacted(widget_id, start, end, field_list), raw_query)
+    if not compacted:
+        return raw
+    return sorted(compacted + raw, key=lambda p: p["timestamp"])
+
+async def fetch_widget_data(
+    widget: Dict[str, Any],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    field_list: Optional[List[str]] = None,
+    shape: str = "rows",
+    aggregate: Optional[str] = None,
+    interval: Optional[str] = None,
+    since: Optional[str] = None
+):
+    if shape not in ("rows", "columns"):
+        raise ValueError("shape must be 'rows' or 'columns'")
+    data_points = await fetch_points(widget, start, end, field_list, since)
+    cursor, data_points = await sync_cursor(widget, data_points, start, end, since)
+    if aggregate:
+        return {"data": aggregate_points(data_points, field_list, aggregate, interval), "cursor": cursor}
+    if shape == "columns":
+        return {"data": to_columns(data_points, field_list), "cursor": cursor}
+    return {"data": data_points, "cursor": cursor}
+
+# Single-flight: concurrent identical reads share one in-flight query and its
+# result (or exception). Shared results must be treated as read-only.
+class SingleFlight:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.in_flight = {}
+        self.stats = {"executed": 0, "shared": 0, "timeouts": 0, "errors": 0}
+    
+    async def do(self, key, fn, timeout: Optional[float] = None):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+            self.stats["executed"] += 1
+        else:
+            self.stats["shared"] += 1
+        try:
+            # shield() so one caller timing out does not cancel the query for the rest
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise HTTPException(status_code=504, detail="Query timed out")
+    
+    def _finish(self, key, future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if not future.cancelled() and future.exception() is not None:
+            self.stats["errors"] += 1
+
+read_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+
+# Write admission: per-user token buckets plus a global cap on in-flight writes.
+# Over the limit a write fails fast with 429/503 and Retry-After instead of queuing.
+class TokenBucketLimiter:
+    MAX_BUCKETS = 10000
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+    
+    async def acquire(self, key: str, cost: float = 1):
+        # Returns 0 when admitted, otherwise seconds until enough tokens refill
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < cost:
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate
+        self.buckets[key] = (tokens - cost, now)
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self._prune(now)
+        return 0
+    
+    def _prune(self, now: float):
+        full_after = self.burst / self.rate
+        self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < full_after}
+    
+    def stats(self):
+        return {"buckets": len(self.buckets)}
+
+class RedisTokenBucketLimiter:
+    SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens < cost then
+    wait = (cost - tokens) / rate
+else
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+    
+    def __init__(self, rate: float, burst: float, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package")
+        self.rate = rate
+        self.burst = burst
+        self.errors = 0
+        self.script = redis.from_url(url).register_script(self.SCRIPT)
+    
+    async def acquire(self, key: str, cost: float = 1):
+        try:
+            wait = await self.script(keys=[f"ratelimit:{key}"], args=[self.rate, self.burst, time.time(), cost])
+            return float(wait)
+        except Exception:
+            # Fail open: a limiter outage should not take writes down with it
+            self.errors += 1
+            return 0
+    
+    def stats(self):
+        return {"backend_errors": self.errors}
+
+def create_rate_limiter():
+    if RATE_LIMIT_BACKEND == "redis":
+        return RedisTokenBucketLimiter(WRITE_RATE_PER_SECOND, WRITE_BURST, REDIS_URL)
+    return TokenBucketLimiter(WRITE_RATE_PER_SECOND, WRITE_BURST)
+
+write_limiter = create_rate_limiter()
+write_admission_stats = {"admitted": 0, "rate_limited": 0, "overloaded": 0, "in_flight": 0}
+
+def write_admission(cost: float = 1):
+    # Marks a route as a write; WriteAdmissionMiddleware charges cost before the body is read
+    def mark(endpoint):
+        endpoint.write_cost = cost
+        return endpoint
+    return mark
+
+def token_subject(scope) -> Optional[str]:
+    authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM]).get("sub")
+    except jwt.PyJWTError:
+        return None
+
+class WriteAdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    def write_cost(self, scope):
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(getattr(route, "endpoint", None), "write_cost", None)
+        return None
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            return await self.app(scope, receive, send)
+        cost = self.write_cost(scope)
+        user_id = token_subject(scope) if cost is not None else None
+        if user_id is None:
+            # Not a write route, or unauthenticated and about to get a 401 from the route
+            return await self.app(scope, receive, send)
+        
+        if write_admission_stats["in_flight"] >= WRITE_MAX_IN_FLIGHT:
+            write_admission_stats["overloaded"] += 1
+            response = JSONResponse({"detail": "Server busy, retry shortly"}, status_code=503, headers={"Retry-After": "1"})
+            return await response(scope, receive, send)
+        
+        # Claim the slot before awaiting the limiter, which suspends with the redis backend
+        write_admission_stats["in_flight"] += 1
+        try:
+            wait = await write_limiter.acquire(user_id, cost)
+            if wait > 0:
+                write_admission_stats["rate_limited"] += 1
+                response = JSONResponse({"detail": "Too many write requests"}, status_code=429, headers={"Retry-After": str(math.ceil(wait))})
+                return await response(scope, receive, send)
+            
+            write_admission_stats["admitted"] += 1
+            await self.app(scope, receive, send)
+        finally:
+            write_admission_stats["in_flight"] -= 1
+
+app.add_middleware(WriteAdmissionMiddleware)
+
+def check_dashboard_access(dashboard: Optional[Dict[str, Any]], current_user):
+    if not dashboard:
+        raise HTTPException(status_code=404, detail="Dashboard not found")
+    
+    # Check if user has access (owner or public dashboard)
+    if dashboard["owner_id"] != current_user["user_id"] and not dashboard.get("is_public", False):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+async def get_accessible_dashboard(dashboard_id: str, current_user):
+    dashboard = await get_loaders().dashboards.load(dashboard_id)
+    check_dashboard_access(dashboard, current_user)
+    
+    return dashboard
+
+async def load_widget(widget_id: str):
+    loaders = get_loaders()
+    widget = await loaders.widgets.load(widget_id)
+    if not widget:
+        return None, None
+    dashboard = await loaders.dashboards.load(widget["dashboard_id"])
+    return widget, dashboard
+
+async def get_accessible_widget(widget_id: str, current_user):
+    # Verify widget access
+    widget, dashboard = await read_flight.do(("widget", widget_id), lambda: load_widget(widget_id))
+    if not widget:
+        raise HTTPException(status_code=404, detail="Widget not found")
+    
+    # Check access (owner or public dashboard)
+    if dashboard["owner_id"] != current_user["user_id"] and not dashboard.get("is_public", False):
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    return widget
+
+async def bump_data_version(widget_ids: List[str]):
+    await db.widgets.update_many(
+        {"widget_id": {"$in": widget_ids}},
+        {"$inc": {"data_version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+
+# Latest-value materialization: one widget_latest document per widget holding the
+# most recent point, the point count and running totals of numeric fields
+def numeric_totals(data: Dict[str, Any]):
+    return {
+        key: value for key, value in data.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+        and not pd.isna(value) and "." not in key and not key.startswith("$")
+    }
+
+async def record_latest(widget_id: str, dashboard_id: str, owner_id: str, last_point: Dict[str, Any], count: int, totals: Dict[str, Any]):
+    increments = {"count": count}
+    increments.update({f"totals.{key}": value for key, value in totals.items()})
+    await db.widget_latest.update_one(
+        {"widget_id": widget_id},
+        {
+            "$inc": increments,
+            "$set": {"updated_at": datetime.utcnow()},
+            "$setOnInsert": {"dashboard_id": dashboard_id, "owner_id": owner_id}
+        },
+        upsert=True
+    )
+    # Only move last_point forward, so backfilled points do not replace newer ones
+    await db.widget_latest.update_one(
+        {
+            "widget_id": widget_id,
+            "$or": [
+                {"last_point": {"$exists": False}},
+                {"last_point.timestamp": {"$lte": last_point["timestamp"]}}
+            ]
+        },
+        {"$set": {"last_point": last_point}}
+    )
+
+# Summary sketches: per widget, field and day, a KLL quantile sketch over numeric
+# values and a HyperLogLog over all scalar values, stored as compressed bytes
+def sketch_values(points: List[Dict[str, Any]]):
+    groups = {}
+    for point in points:
+        day = day_start(point["timestamp"])
+        for key, value in point["data"].items():
+            if key.startswith("$") or value is None or not isinstance(value, (str, int, float, bool)):
+                continue
+            if isinstance(value, float) and math.isnan(value):
+                continue
+            group = groups.setdefault((day, key), {"numeric": [], "values": []})
+            group["values"].append(value)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                group["numeric"].append(value)
+    return groups
+
+async def merge_sketch(widget_id: str, bucket: datetime, field: str, numeric: List[float], values: List[Any]):
+    key = {"widget_id": widget_id, "field": field, "bucket": bucket}
+    # Optimistic read-merge-write; the version check catches concurrent ingestion
+    for _ in range(SKETCH_MAX_RETRIES):
+        doc = await db.widget_sketches.find_one(key, {"_id": 0})
+        kll = KLLSketch.from_bytes(doc["kll"]) if doc else KLLSketch()
+        hll = HyperLogLog.from_bytes(doc["hll"]) if doc else HyperLogLog()
+        kll.update_many(numeric)
+        hll.update_many(values)
+        fields = {
+            "kll": kll.to_bytes(),
+            "hll": hll.to_bytes(),
+            "count": (doc["count"] if doc else 0) + len(values),
+            "version": (doc["version"] if doc else 0) + 1
+        }
+        if doc is None:
+            try:
+                await db.widget_sketches.insert_one({**key, **fields})
+                return
+            except DuplicateKeyError:
+                continue
+        result = await db.widget_sketches.update_one({**key, "version": doc["version"]}, {"$set": fields})
+        if result.modified_count:
+            return
+    logger.warning("Sketch update for widget %s field %s lost after %d retries", widget_id, field, SKETCH_MAX_RETRIES)
+
+async def update_sketches(widget_id: str, points: List[Dict[str, Any]]):
+    groups = sketch_values(points)
+    # A long CSV spans many (day, field) buckets; cap the merges in flight at once
+    semaphore = asyncio.Semaphore(SKETCH_CONCURRENCY)
+    
+    async def merge(day: datetime, field: str, group: Dict[str, List[Any]]):
+        async with semaphore:
+            await merge_sketch(widget_id, day, field, group["numeric"], group["values"])
+    
+    await asyncio.gather(*(merge(day, field, group) for (day, field), group in groups.items()))
+
+async def record_points_written(
+    widget_id: str,
+    dashboard_id: str,
+    owner_id: str,
+    points: List[Dict[str, Any]],
+    totals: Optional[Dict[str, Any]] = None,
+    bump_version: bool = True
+):
+    last_point = max(points, key=lambda p: p["timestamp"])
+    if totals is None:
+        totals = {}
+        for point in points:
+            for key, value in numeric_totals(point["data"]).items():
+                totals[key] = totals.get(key, 0) + value
+    updates = [
+        record_latest(
+            widget_id,
+            dashboard_id,
+            owner_id,
+            {"data_id": last_point["data_id"], "data": last_point["data"], "timestamp": last_point["timestamp"]},
+            len(points),
+            totals
+        ),
+        update_sketches(widget_id, points)
+    ]
+    if bump_version:
+        updates.append(bump_data_version([widget_id]))
+    await asyncio.gather(*updates)
+
+# Derived metrics: widget config["derived"] is a list of specs such as
+#   {"name": "weight_ma", "op": "moving_average", "field": "weight", "window": 7}
+#   {"name": "volume", "op": "expression", "expr": "sets * reps * weight", "reduce": "sum"}
+# evaluated in order, so later specs may use earlier names as fields
+EXPR_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+DERIVED_REDUCERS = {
+    "last": lambda s: s.dropna().iloc[-1] if s.notna().any() else None,
+    "sum": lambda s: s.sum(),
+    "mean": lambda s: s.mean(),
+    "min": lambda s: s.min(),
+    "max": lambda s: s.max(),
+    "count": lambda s: s.count(),
+}
+# Over compacted days only these ops and reducers are exact; the rest see daily means
+COMPACTED_EXACT_OPS = {"cumulative_sum", "percent_of_goal"}
+COMPACTED_EXACT_REDUCERS = {"sum", "count", "mean"}
+# Deeply nested expressions would otherwise exhaust the parser and evaluator stacks
+EXPR_MAX_LENGTH = 500
+EXPR_MAX_NODES = 200
+derived_cache = OrderedDict()
+
+def parse_expression(expr: str):
+    if not isinstance(expr, str) or len(expr) > EXPR_MAX_LENGTH:
+        raise ValueError(f"Expressions must be strings of at most {EXPR_MAX_LENGTH} characters")
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except (SyntaxError, RecursionError, MemoryError):
+        raise ValueError(f"Invalid expression: {expr}")
+    if sum(1 for _ in ast.walk(tree)) > EXPR_MAX_NODES:
+        raise ValueError(f"Expression is too complex: {expr}")
+    return tree
+
+def expression_fields(expr: str):
+    return {node.id for node in ast.walk(parse_expression(expr)) if isinstance(node, ast.Name)}
+
+def spec_number(spec: Dict[str, Any], key: str, default, cast=int):
+    value = spec.get(key)
+    try:
+        return cast(default if value is None else value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a number")
+
+def numeric_column(frame: pd.DataFrame, field: str):
+    if field not in frame and frame.empty:
+        return pd.Series(index=frame.index, dtype="float64")
+    if field not in frame:
+        raise ValueError(f"Unknown field: {field}")
+    return pd.to_numeric(frame[field], errors="coerce")
+
+def eval_expression(expr: str, frame: pd.DataFrame):
+    def visit(node):
+        if isinstance(node, ast.Expression):
+            return visit(node.body)
+        if isinstance(node, ast.BinOp) and type(node.op) in EXPR_OPERATORS:
+            return EXPR_OPERATORS[type(node.op)](visit(node.left), visit(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -visit(node.operand)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            # Floats overflow to inf instead of growing like Python ints (9 ** 9 ** 9)
+            return np.float64(node.value)
+        if isinstance(node, ast.Name):
+            return numeric_column(frame, node.id)
+        raise ValueError(f"Unsupported expression: {expr}")
+    try:
+        with np.errstate(all="ignore"):
+            result = visit(parse_expression(expr))
+    except (ArithmeticError, TypeError, RecursionError) as e:
+        raise ValueError(f"Cannot evaluate {expr}: {e}")
+    if not isinstance(result, pd.Series):
+        result = pd.Series(result, index=frame.index, dtype="float64")
+    return result
+
+def derived_source_fields(specs: List[Dict[str, Any]]):
+    fields, produced = set(), set()
+    for spec in specs:
+        needed = expression_fields(spec.get("expr", "")) if spec.get("op") == "expression" else {spec.get("field")}
+        fields |= {f for f in needed if f and f not in produced}
+        produced.add(spec.get("name"))
+    return sorted(fields)
+
+def compute_derived_series(spec: Dict[str, Any], frame: pd.DataFrame, weight: Optional[pd.Series] = None):
+    op = spec.get("op")
+    if op == "expression":
+        return eval_expression(spec.get("expr", ""), frame)
+    values = numeric_column(frame, spec.get("field"))
+    if op == "moving_average":
+        return values.rolling(spec_number(spec, "window", 7), min_periods=1).mean()
+    if op == "cumulative_sum":
+        return (values if weight is None else values * weight).cumsum()
+    if op == "rate_of_change":
+        return values.pct_change(spec_number(spec, "periods", 1), fill_method=None) * 100
+    if op == "percent_of_goal":
+        goal = spec_number(spec, "goal", 0, float)
+        if not goal:
+            raise ValueError("percent_of_goal requires a non-zero goal")
+        return values / goal * 100
+    raise ValueError(f"Unknown derived op: {op}")
+
+def to_json_values(series: pd.Series):
+    series = series.replace([np.inf, -np.inf], np.nan)
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def to_json_scalar(value):
+    if value is None or pd.isna(value) or np.isinf(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+def weighted_reduce(how: str, series: pd.Series, weight: Optional[pd.Series]):
+    if weight is None or how not in ("sum", "count", "mean"):
+        return DERIVED_REDUCERS[how](series)
+    present = weight[series.notna()].sum()
+    if how == "count":
+        return int(present)
+    total = (series * weight).sum()
+    if how == "sum":
+        return total
+    return total / present if present else None
+
+def evaluate_derived(specs: List[Dict[str, Any]], points: List[Dict[str, Any]]):
+    frame = pd.DataFrame.from_records([p.get("data", {}) for p in points])
+    # A compacted day is a mean over its points, so it counts as that many points
+    # in cumulative sums and sum/count/mean reductions
+    weights, counts, day_weight = {}, None, None
+    if any(p.get("compacted") for p in points):
+        counts = pd.DataFrame.from_records(
+            [p["stats"].get("counts", {}) if p.get("compacted") else {} for p in points], index=frame.index
+        )
+        day_weight = pd.Series([p.get("count", 1) if p.get("compacted") else 1 for p in points], index=frame.index, dtype="float64")
+    result = {"timestamp": None, "series": {}, "values": {}, "approximate": []}
+    inexact = set()
+    for spec in specs:
+        name = spec.get("name")
+        if not name:
+            raise ValueError("Derived spec requires a name")
+        field = spec.get("field") if spec.get("op") != "expression" else None
+        sources = expression_fields(spec.get("expr", "")) if spec.get("op") == "expression" else {field}
+        if spec.get("op") not in COMPACTED_EXACT_OPS or sources & inexact:
+            inexact.add(name)
+        if counts is not None and (name in inexact or spec.get("reduce") not in COMPACTED_EXACT_REDUCERS | {None}):
+            result["approximate"].append(name)
+        weight = day_weight
+        if field in weights:
+            weight = weights[field]
+        elif counts is not None and field in counts:
+            weight = pd.to_numeric(counts[field], errors="coerce").fillna(1)
+        series = compute_derived_series(spec, frame, weight)
+        frame[name] = series
+        weights[name] = weight
+        reduce = spec.get("reduce")
+        if reduce:
+            if reduce not in DERIVED_REDUCERS:
+                raise ValueError(f"Unknown reducer: {reduce}")
+            result["values"][name] = to_json_scalar(weighted_reduce(reduce, series, weight))
+        else:
+            result["series"][name] = to_json_values(series)
+    if result["series"]:
+        result["timestamp"] = [p["timestamp"].isoformat() for p in points]
+    return result
+
+# Raised by standalone mongod, which has no multi-document transactions
+TRANSACTIONS_UNSUPPORTED = 20
+
+async def remove_dashboard_bundle(dashboard_id: str):
+    await data_router.scatter(lambda points: points.delete_many({"dashboard_id": dashboard_id}))
+    await db.widgets.delete_many({"dashboard_id": dashboard_id})
+    await db.dashboards.delete_one({"dashboard_id": dashboard_id})
+
+async def insert_dashboard_bundle(dashboard_doc: Dict[str, Any], widget_docs: List[Dict[str, Any]], data_docs: List[Dict[str, Any]]):
+    # Points on other instances cannot join the main client's transaction
+    local_docs = data_docs if data_router.local else []
+    remote_docs = [] if data_router.local else data_docs
+    
+    async def write(session):
+        await db.dashboards.insert_one(dashboard_doc, session=session)
+        if widget_docs:
+            await db.widgets.insert_many(widget_docs, session=session)
+        if local_docs:
+            await data_router.insert_many(local_docs, session=session)
+    
+    try:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                await write(session)
+    except OperationFailure as e:
+        if e.code != TRANSACTIONS_UNSUPPORTED:
+            raise
+        # No transactions available, so undo partial writes by hand on failure
+        try:
+            await write(None)
+        except Exception:
+            await remove_dashboard_bundle(dashboard_doc["dashboard_id"])
+            raise
+    
+    if remote_docs:
+        try:
+            await data_router.insert_many(remote_docs)
+        except Exception:
+            await remove_dashboard_bundle(dashboard_doc["dashboard_id"])
+            raise
+
+# Social graph: friendships and dashboard follows are edge documents, with
+# friends_count / followers_count kept on the parent so hot reads stay small
+async def add_edge(collection, edge: Dict[str, Any], counter_collection, counter_filter: Dict[str, Any], counter: str):
+    result = await collection.update_one(
+        edge,
+        {"$setOnInsert": {"created_at": datetime.utcnow()}},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        await counter_collection.update_one(counter_filter, {"$inc": {counter: 1}})
+    return result.upserted_id is not None
+
+async def remove_edge(collection, edge: Dict[str, Any], counter_collection, counter_filter: Dict[str, Any], counter: str):
+    result = await collection.delete_one(edge)
+    if result.deleted_count:
+        await counter_collection.update_one(counter_filter, {"$inc": {counter: -1}})
+    return bool(result.deleted_count)
+
+async def attach_owners(dashboards: List[Dict[str, Any]]):
+    owner_ids = list({d["owner_id"] for d in dashboards})
+    owners = await get_loaders().users.load_many(owner_ids)
+    owners_by_id = {
+        owner_id: {"username": owner["username"], "full_name": owner.get("full_name")}
+        for owner_id, owner in zip(owner_ids, owners) if owner
+    }
+    for dashboard in dashboards:
+        dashboard["owner"] = owners_by_id.get(dashboard["owner_id"])
+    return dashboards
+
+async def query_public_dashboards(skip: int, limit: int):
+    dashboards = await db.dashboards.find(
+        {"is_public": True},
+        {**DASHBOARD_PROJECTION, "owner_password": 0}
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(None)
+    return await attach_owners(dashboards)
+
+# Discover feed snapshot: the first DISCOVER_SNAPSHOT_PAGES pages of the public
+# feed, owners embedded, rebuilt on an interval or when a public dashboard changes
+discover_snapshot = {"dashboards": [], "complete": False, "built_at": None}
+discover_snapshot_dirty = asyncio.Event()
+
+async def refresh_discover_snapshot():
+    capacity = DISCOVER_PAGE_SIZE * DISCOVER_SNAPSHOT_PAGES
+    dashboards = await query_public_dashboards(0, capacity)
+    discover_snapshot.update({
+        "dashboards": dashboards,
+        "complete": len(dashboards) < capacity,
+        "built_at": time.monotonic()
+    })
+
+def invalidate_discover_snapshot():
+    discover_snapshot_dirty.set()
+
+async def discover_snapshot_loop():
+    while True:
+        try:
+            await refresh_discover_snapshot()
+        except Exception:
+            logger.exception("Discover snapshot refresh failed")
+        try:
+            await asyncio.wait_for(discover_snapshot_dirty.wait(), timeout=DISCOVER_SNAPSHOT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        discover_snapshot_dirty.clear()
+
+def read_discover_snapshot(skip: int, limit: int):
+    if discover_snapshot["built_at"] is None or discover_snapshot_dirty.is_set():
+        return None
+    dashboards = discover_snapshot["dashboards"]
+    if skip + limit > len(dashboards) and not discover_snapshot["complete"]:
+        return None
+    return dashboards[skip:skip + limit]
+
+# Retention: raw points older than a dashboard's retention.raw_days are folded into
+# per-day aggregates in data_daily, then deleted in bounded batches
+def day_start(ts: datetime):
+    return datetime(ts.year, ts.month, ts.day)
+
+def daily_updates(points: List[Dict[str, Any]]):
+    days = {}
+    for point in points:
+        days.setdefault(day_start(point["timestamp"]), []).append(point)
+    for day, group in days.items():
+        increments, minimums, maximums = {"count": len(group)}, {}, {}
+        for point in group:
+            for key, value in numeric_totals(point["data"]).items():
+                increments[f"sum.{key}"] = increments.get(f"sum.{key}", 0) + value
+                increments[f"counts.{key}"] = increments.get(f"counts.{key}", 0) + 1
+                minimums[f"min.{key}"] = min(minimums.get(f"min.{key}", value), value)
+                maximums[f"max.{key}"] = max(maximums.get(f"max.{key}", value), value)
+        update = {
+            "$inc": increments,
+            "$setOnInsert": {"dashboard_id": group[0]["dashboard_id"], "owner_id": group[0]["owner_id"]}
+        }
+        if minimums:
+            update["$min"] = minimums
+            update["$max"] = maximums
+        # Identifies this slice of raw points so a retried batch is not counted twice
+        batch_key = f"{group[0]['data_id']}:{group[-1]['data_id']}:{len(group)}"
+        update["$addToSet"] = {"batches": batch_key}
+        yield day, batch_key, update
+
+async def compact_widget(widget: Dict[str, Any], cutoff: datetime, compact: bool = True):
+    widget_id = widget["widget_id"]
+    data_points = data_router.route(widget)
+    removed = 0
+    while True:
+        points = await data_points.find(
+            {"widget_id": widget_id, "timestamp": {"$lt": cutoff}},
+            {"_id": 0}
+        ).sort([("timestamp", 1), ("data_id", 1)]).limit(RETENTION_BATCH_SIZE).to_list(None)
+        if not points:
+            return removed
+        
+        if compact:
+            for day, batch_key, update in daily_updates(points):
+                try:
+                    await db.data_daily.update_one(
+                        {"widget_id": widget_id, "day": day, "batches": {"$ne": batch_key}},
+                        update,
+                        upsert=True
+                    )
+                except DuplicateKeyError:
+                    pass  # batch already applied before an interrupted delete
+        
+        await data_points.delete_many({
+            "widget_id": widget_id,
+            "timestamp": {"$lte": points[-1]["timestamp"]},
+            "data_id": {"$in": [p["data_id"] for p in points]}
+        })
+        removed += len(points)
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+async def run_retention():
+    dashboards = await db.dashboards.find(
+        {"retention.raw_days": {"$type": "number"}},
+        {"_id": 0, "dashboard_id": 1, "retention": 1}
+    ).to_list(None)
+    for dashboard in dashboards:
+        retention = dashboard["retention"]
+        # Whole days only, so a day is never split between raw and compacted data
+        cutoff = day_start(datetime.utcnow() - timedelta(days=retention["raw_days"]))
+        widgets = await db.widgets.find(
+            {"dashboard_id": dashboard["dashboard_id"]},
+            {"_id": 0, "widget_id": 1, "owner_id": 1}
+        ).to_list(None)
+        changed = []
+        for widget in widgets:
+            if await compact_widget(widget, cutoff, retention.get("compact", True)):
+                changed.append(widget["widget_id"])
+        if changed:
+            await bump_data_version(changed)
+
+async def retention_loop():
+    while True:
+        try:
+            await run_retention()
+        except Exception:
+            logger.exception("Retention run failed")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# Dashboard thumbnails: small images of each public dashboard's first widgets drawn
+# from downsampled data, stored content-addressed under UPLOAD_FOLDER/thumbnails
+# and regenerated only when a widget or its data_version changes
+THUMBNAIL_GRID = (3, 2)
+THUMBNAIL_COLORS = {"blue": "#3B82F6", "green": "#10B981", "orange": "#F97316", "purple": "#8B5CF6"}
+
+def thumbnail_key(dashboard: Dict[str, Any], widgets: List[Dict[str, Any]]):
+    content = [dashboard["dashboard_id"], dashboard.get("title")] + [
+        [w["widget_id"], w.get("widget_type"), w.get("title"), w.get("data_version", 0)] for w in widgets
+    ]
+    return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()[:32]
+
+def widget_color(widget: Dict[str, Any]):
+    color = str((widget.get("config") or {}).get("color", "blue"))
+    if color in THUMBNAIL_COLORS:
+        return THUMBNAIL_COLORS[color]
+    # config is free-form, so anything Pillow cannot draw falls back to the default
+    try:
+        return ImageColor.getrgb(color)
+    except ValueError:
+        return THUMBNAIL_COLORS["blue"]
+
+def downsample(values: List[float], size: int):
+    if len(values) <= size:
+        return values
+    return [values[int(i)] for i in np.linspace(0, len(values) - 1, size)]
+
+def render_thumbnail(tiles: List[Dict[str, Any]], path: Path):
+    width, height = THUMBNAIL_SIZE
+    columns, rows = THUMBNAIL_GRID
+    tile_width, tile_height = width // columns, height // rows
+    image = Image.new("RGB", THUMBNAIL_SIZE, "#F9FAFB")
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    
+    for index, tile in enumerate(tiles):
+        left, top = (index % columns) * tile_width + 6, (index // columns) * tile_height + 6
+        right, bottom = left + tile_width - 12, top + tile_height - 12
+        draw.rounded_rectangle((left, top, right, bottom), radius=8, fill="white", outline="#E5E7EB")
+        draw.text((left + 8, top + 6), tile["title"][:24], fill="#374151", font=font)
+        inner = (left + 8, top + 26, right - 8, bottom - 8)
+        color = tile["color"]
+        
+        if tile["kind"] == "chart" and len(tile["values"]) > 1:
+            low, high = min(tile["values"]), max(tile["values"])
+            span = (high - low) or 1
+            step = (inner[2] - inner[0]) / (len(tile["values"]) - 1)
+            line = [(inner[0] + i * step, inner[3] - (v - low) / span * (inner[3] - inner[1])) for i, v in enumerate(tile["values"])]
+            draw.line(line, fill=color, width=2)
+        elif tile["kind"] == "progress" and tile["ratio"] is not None:
+            middle = (inner[1] + inner[3]) // 2
+            draw.rounded_rectangle((inner[0], middle - 6, inner[2], middle + 6), radius=6, fill="#E5E7EB")
+            filled = inner[0] + (inner[2] - inner[0]) * max(0.0, min(1.0, tile["ratio"]))
+            if filled > inner[0] + 6:
+                draw.rounded_rectangle((inner[0], middle - 6, filled, middle + 6), radius=6, fill=color)
+        elif tile["kind"] == "metric" and tile["value"] is not None:
+            draw.text((inner[0], (inner[1] + inner[3]) // 2 - 6), tile["value"], fill=color, font=font)
+        elif tile["kind"] == "table":
+            for row in range(4):
+                y = inner[1] + 4 + row * 14
+                draw.rectangle((inner[0], y, inner[2] - (row % 2) * 20, y + 6), fill="#E5E7EB")
+    
+    image.save(path, format=THUMBNAIL_FORMAT)
+
+async def thumbnail_tiles(widgets: List[Dict[str, Any]]):
+    latest = await db.widget_latest.find(
+        {"widget_id": {"$in": [w["widget_id"] for w in widgets]}},
+        {"_id": 0, "widget_id": 1, "last_point": 1}
+    ).to_list(None)
+    latest_by_widget = {doc["widget_id"]: (doc.get("last_point") or {}).get("data", {}) for doc in latest}
+    
+    tiles = []
+    for widget in widgets:
+        config = widget.get("config") or {}
+        kind = widget.get("widget_type", "metric")
+        tile = {"title": widget.get("title") or "", "kind": kind, "color": widget_color(widget), "values": [], "value": None, "ratio": None}
+        last_data = latest_by_widget.get(widget["widget_id"], {})
+        numeric = numeric_totals(last_data)
+        y_axis = config.get("y_axis")
+        field = y_axis if isinstance(y_axis, str) and y_axis in numeric else next(iter(numeric), None)
+        
+        if kind == "chart" and field:
+            # Newest points only, then an even stride across them
+            points = await data_router.route(widget).find(
+                {"widget_id": widget["widget_id"]},
+                {"_id": 0, "timestamp": 1, f"data.{field}": 1}
+            ).sort("timestamp", -1).limit(THUMBNAIL_POINTS * 4).to_list(None)
+            values = [p["data"][field] for p in reversed(points) if isinstance(p.get("data", {}).get(field), (int, float))]
+            tile["values"] = downsample(values, THUMBNAIL_POINTS)
+        elif kind == "progress" and field:
+            try:
+                target = float(config.get("target") or config.get("goal") or 0)
+            except (TypeError, ValueError):
+                target = 0
+            tile["ratio"] = numeric[field] / target if target else None
+        elif kind == "metric" and field:
+            tile["value"] = f"{numeric[field]:,}"
+        tiles.append(tile)
+    return tiles
+
+async def refresh_thumbnails():
+    dashboards = await db.dashboards.find(
+        {"is_public": True},
+        {"_id": 0, "dashboard_id": 1, "title": 1, "thumbnail_key": 1}
+    ).to_list(None)
+    widgets = await db.widgets.find(
+        {"dashboard_id": {"$in": [d["dashboard_id"] for d in dashboards]}},
+        {"_id": 0, "widget_id": 1, "dashboard_id": 1, "owner_id": 1, "widget_type": 1, "title": 1, "config": 1, "data_version": 1, "created_at": 1}
+    ).sort("created_at", 1).to_list(None)
+    widgets_by_dashboard = {}
+    for widget in widgets:
+        widgets_by_dashboard.setdefault(widget["dashboard_id"], []).append(widget)
+    
+    changed = False
+    for dashboard in dashboards:
+        shown = widgets_by_dashboard.get(dashboard["dashboard_id"], [])[:THUMBNAIL_GRID[0] * THUMBNAIL_GRID[1]]
+        key = thumbnail_key(dashboard, shown)
+        path = THUMBNAIL_FOLDER / f"{key}.{THUMBNAIL_FORMAT}"
+        if key == dashboard.get("thumbnail_key") and path.exists():
+            continue
+        
+        try:
+            tiles = await thumbnail_tiles(shown)
+            await asyncio.to_thread(render_thumbnail, tiles, path)
+        except Exception:
+            # One bad widget config skips only its own dashboard
+            logger.exception("Thumbnail render failed for dashboard %s", dashboard["dashboard_id"])
+            continue
+        await db.dashboards.update_one(
+            {"dashboard_id": dashboard["dashboard_id"]},
+            {"$set": {"thumbnail_key": key, "thumbnail_url": f"/uploads/thumbnails/{path.name}"}}
+        )
+        if dashboard.get("thumbnail_key") and dashboard["thumbnail_key"] != key:
+            for old in THUMBNAIL_FOLDER.glob(f"{dashboard['thumbnail_key']}.*"):
+                old.unlink(missing_ok=True)
+        changed = True
+    
+    if changed:
+        invalidate_discover_snapshot()
+
+async def thumbnail_loop():
+    while True:
+        try:
+            await refresh_thumbnails()
+        except Exception:
+            logger.exception("Thumbnail refresh failed")
+        await asyncio.sleep(THUMBNAIL_INTERVAL)
+
+background_tasks = []
+
+@app.on_event("startup")
+async def ensure_indexes():
+    await db.dashboards.create_index([("is_public", 1), ("created_at", -1)])
+    await data_router.scatter(lambda points: points.create_index([("widget_id", 1), ("timestamp", 1)]))
+    await data_router.scatter(lambda points: points.create_index([("widget_id", 1), ("seq", 1)]))
+    if DATA_PARTITION_KEY == "owner_id":
+        await data_router.scatter(lambda points: points.create_index("owner_id"))
+    await db.widget_latest.create_index("widget_id", unique=True)
+    await db.widget_latest.create_index("dashboard_id")
+    await db.friendships.create_index([("user_id", 1), ("friend_id", 1)], unique=True)
+    await db.dashboard_followers.create_index([("dashboard_id", 1), ("user_id", 1)], unique=True)
+    await db.dashboard_followers.create_index("user_id")
+    await db.data_daily.create_index([("widget_id", 1), ("day", 1)], unique=True)
+    await db.widget_sketches.create_index([("widget_id", 1), ("field", 1), ("bucket", 1)], unique=True)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(discover_snapshot_loop()))
+    background_tasks.append(asyncio.create_task(retention_loop()))
+    background_tasks.append(asyncio.create_task(thumbnail_loop()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+
 # Routes
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "service": "Personal Dashboard Platform API"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    # Scatter-gather: estimated point counts per partition, in configured order
+    # (names are left out since unnamed partitions are identified by their URL)
+    counts = await data_router.scatter(lambda points: points.estimated_document_count())
+    return {
+        "data_partitions": {"key": data_router.key, "points": counts},
+        "single_flight": {**read_flight.stats, "in_flight": len(read_flight.in_flight)},
+        "write_admission": {
+            **write_admission_stats,
+            "max_in_flight": WRITE_MAX_IN_FLIGHT,
+            "rate_per_second": WRITE_RATE_PER_SECOND,
+            "burst": WRITE_BURST,
+            "backend": RATE_LIMIT_BACKEND,
+            **write_limiter.stats()
+        }
+    }
+
 @app.post("/api/auth/register")
 async def register(user_data: UserRegister):
     # Check if user exists
@@ -132,7 +1494,7 @@ async def register(user_data: UserRegister):
         "password_hash": hashed_password,
         "created_at": datetime.utcnow(),
         "is_active": True,
-        "friends": [],
+        "friends_count": 0,
         "public_profile": True
     }
     
@@ -173,12 +1535,14 @@ async def get_current_user_info(current_user = Depends(get_current_user)):
         "email": current_user["email"],
         "full_name": current_user.get("full_name"),
         "created_at": current_user["created_at"],
-        "friends_count": len(current_user.get("friends", []))
+        "friends_count": current_user.get("friends_count", 0)
     }
 
 @app.post("/api/dashboards")
+@write_admission()
 async def create_dashboard(dashboard_data: DashboardCreate, current_user = Depends(get_current_user)):
     dashboard_id = str(uuid.uuid4())
+    now = datetime.utcnow()
     
     dashboard_doc = {
         "dashboard_id": dashboard_id,
@@ -188,55 +1552,180 @@ async def create_dashboard(dashboard_data: DashboardCreate, current_user = Depen
         "template_type": dashboard_data.template_type,
         "is_public": dashboard_data.is_public,
         "custom_domain": dashboard_data.custom_domain,
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
+        "created_at": now,
+        "updated_at": now,
         "widgets": [],
         "layout": {},
         "theme": "default",
         "views": 0,
-        "followers": []
+        "followers_count": 0
     }
     
-    await db.dashboards.insert_one(dashboard_doc)
+    widgets = list(dashboard_data.widgets)
+    if dashboard_data.use_template_widgets:
+        widgets = DASHBOARD_TEMPLATES.get(dashboard_data.template_type, []) + widgets
+    
+    widget_docs, data_docs, seeded = [], [], []
+    for index, widget in enumerate(widgets):
+        widget_id = str(uuid.uuid4())
+        widget_docs.append({
+            "widget_id": widget_id,
+            "dashboard_id": dashboard_id,
+            "owner_id": current_user["user_id"],
+            "widget_type": widget.widget_type,
+            "title": widget.title,
+            "position": widget.position or {"x": (index % 3) * 4, "y": (index // 3) * 4, "width": 4, "height": 4},
+            "config": dict(widget.config),
+            "data_source": widget.data_source,
+            "data_version": 1 if widget.data else 0,
+            "seq": len(widget.data),
+            "created_at": now,
+            "updated_at": now
+        })
+        points = [{
+            "data_id": str(uuid.uuid4()),
+            "dashboard_id": dashboard_id,
+            "widget_id": widget_id,
+            "owner_id": current_user["user_id"],
+            "data": point.data,
+            "timestamp": point.timestamp or now,
+            "created_at": now,
+            "seq": seq
+        } for seq, point in enumerate(widget.data, start=1)]
+        if points:
+            data_docs.extend(points)
+            seeded.append((widget_id, points))
+    
+    await insert_dashboard_bundle(dashboard_doc, widget_docs, data_docs)
+    
+    # Seeded widgets were inserted with data_version 1 already
+    await asyncio.gather(*(
+        record_points_written(widget_id, dashboard_id, current_user["user_id"], points, bump_version=False)
+        for widget_id, points in seeded
+    ))
     
-    return {"dashboard_id": dashboard_id, "message": "Dashboard created successfully"}
+    if dashboard_doc["is_public"]:
+        invalidate_discover_snapshot()
+    
+    return {
+        "dashboard_id": dashboard_id,
+        "widget_ids": [w["widget_id"] for w in widget_docs],
+        "message": "Dashboard created successfully"
+    }
 
 @app.get("/api/dashboards")
 async def get_user_dashboards(current_user = Depends(get_current_user)):
     dashboards = await db.dashboards.find(
         {"owner_id": current_user["user_id"]},
-        {"_id": 0, "password_hash": 0}
+        {**DASHBOARD_PROJECTION, "password_hash": 0}
     ).to_list(None)
     
     return {"dashboards": dashboards}
 
-@app.get("/api/dashboards/{dashboard_id}")
-async def get_dashboard(dashboard_id: str, current_user = Depends(get_current_user)):
-    dashboard = await db.dashboards.find_one(
-        {"dashboard_id": dashboard_id},
-        {"_id": 0}
-    )
-    
+async def load_dashboard(dashboard_id: str):
+    dashboard = await get_loaders().dashboards.load(dashboard_id)
     if not dashboard:
-        raise HTTPException(status_code=404, detail="Dashboard not found")
-    
-    # Check if user has access (owner or public dashboard)
-    if dashboard["owner_id"] != current_user["user_id"] and not dashboard.get("is_public", False):
-        raise HTTPException(status_code=403, detail="Access denied")
+        return None
     
     # Get widgets for this dashboard
     widgets = await db.widgets.find(
         {"dashboard_id": dashboard_id},
-        {"_id": 0}
+        WIDGET_PROJECTION
     ).to_list(None)
-    dashboard["widgets"] = widgets
+    
+    return {**dashboard, "widgets": widgets}
+
+@app.get("/api/dashboards/{dashboard_id}")
+async def get_dashboard(dashboard_id: str, current_user = Depends(get_current_user)):
+    dashboard = await read_flight.do(("dashboard", dashboard_id), lambda: load_dashboard(dashboard_id))
+    check_dashboard_access(dashboard, current_user)
     
     return dashboard
 
+@app.get("/api/dashboards/{dashboard_id}/latest")
+async def get_dashboard_latest(dashboard_id: str, current_user = Depends(get_current_user)):
+    await get_accessible_dashboard(dashboard_id, current_user)
+    
+    latest = await db.widget_latest.find(
+        {"dashboard_id": dashboard_id},
+        {"_id": 0, "owner_id": 0}
+    ).to_list(None)
+    
+    return {"latest": {doc.pop("widget_id"): doc for doc in latest}}
+
+@app.put("/api/dashboards/{dashboard_id}/retention")
+@write_admission()
+async def update_retention(dashboard_id: str, retention: RetentionSettings, current_user = Depends(get_current_user)):
+    dashboard = await get_accessible_dashboard(dashboard_id, current_user)
+    if dashboard["owner_id"] != current_user["user_id"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if retention.raw_days is not None and retention.raw_days < 1:
+        raise HTTPException(status_code=400, detail="raw_days must be at least 1")
+    
+    await db.dashboards.update_one(
+        {"dashboard_id": dashboard_id},
+        {"$set": {"retention": retention.model_dump(), "updated_at": datetime.utcnow()}}
+    )
+    
+    return {"message": "Retention updated", "retention": retention.model_dump()}
+
+@app.post("/api/dashboards/{dashboard_id}/follow")
+@write_admission()
+async def follow_dashboard(dashboard_id: str, current_user = Depends(get_current_user)):
+    await get_accessible_dashboard(dashboard_id, current_user)
+    
+    await add_edge(
+        db.dashboard_followers,
+        {"dashboard_id": dashboard_id, "user_id": current_user["user_id"]},
+        db.dashboards, {"dashboard_id": dashboard_id}, "followers_count"
+    )
+    
+    return {"message": "Dashboard followed"}
+
+@app.delete("/api/dashboards/{dashboard_id}/follow")
+@write_admission()
+async def unfollow_dashboard(dashboard_id: str, current_user = Depends(get_current_user)):
+    await remove_edge(
+        db.dashboard_followers,
+        {"dashboard_id": dashboard_id, "user_id": current_user["user_id"]},
+        db.dashboards, {"dashboard_id": dashboard_id}, "followers_count"
+    )
+    
+    return {"message": "Dashboard unfollowed"}
+
+@app.post("/api/friends/{friend_id}")
+@write_admission()
+async def add_friend(friend_id: str, current_user = Depends(get_current_user)):
+    if friend_id == current_user["user_id"]:
+        raise HTTPException(status_code=400, detail="Cannot add yourself as a friend")
+    friend = await get_loaders().users.load(friend_id)
+    if not friend:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    await add_edge(
+        db.friendships,
+        {"user_id": current_user["user_id"], "friend_id": friend_id},
+        db.users, {"user_id": current_user["user_id"]}, "friends_count"
+    )
+    
+    return {"message": "Friend added"}
+
+@app.delete("/api/friends/{friend_id}")
+@write_admission()
+async def remove_friend(friend_id: str, current_user = Depends(get_current_user)):
+    await remove_edge(
+        db.friendships,
+        {"user_id": current_user["user_id"], "friend_id": friend_id},
+        db.users, {"user_id": current_user["user_id"]}, "friends_count"
+    )
+    
+    return {"message": "Friend removed"}
+
 @app.post("/api/widgets")
+@write_admission()
 async def create_widget(widget_data: WidgetCreate, current_user = Depends(get_current_user)):
     # Verify dashboard ownership
-    dashboard = await db.dashboards.find_one({"dashboard_id": widget_data.dashboard_id})
+    dashboard = await get_loaders().dashboards.load(widget_data.dashboard_id)
     if not dashboard or dashboard["owner_id"] != current_user["user_id"]:
         raise HTTPException(status_code=403, detail="Access denied")
     
@@ -251,6 +1740,7 @@ async def create_widget(widget_data: WidgetCreate, current_user = Depends(get_cu
         "position": widget_data.position,
         "config": widget_data.config,
         "data_source": widget_data.data_source,
+        "data_version": 0,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
@@ -260,9 +1750,10 @@ async def create_widget(widget_data: WidgetCreate, current_user = Depends(get_cu
     return {"widget_id": widget_id, "message": "Widget created successfully"}
 
 @app.post("/api/data")
+@write_admission()
 async def add_data_point(data_point: DataPointCreate, current_user = Depends(get_current_user)):
     # Verify widget ownership
-    widget = await db.widgets.find_one({"widget_id": data_point.widget_id})
+    widget = await get_loaders().widgets.load(data_point.widget_id)
     if not widget or widget["owner_id"] != current_user["user_id"]:
         raise HTTPException(status_code=403, detail="Access denied")
     
@@ -273,47 +1764,290 @@ async def add_data_point(data_point: DataPointCreate, current_user = Depends(get
         "owner_id": current_user["user_id"],
         "data": data_point.data,
         "timestamp": data_point.timestamp or datetime.utcnow(),
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        "seq": await reserve_seq(data_point.widget_id, 1)
     }
     
-    await db.data_points.insert_one(data_doc)
+    await data_router.route(data_doc).insert_one(data_doc)
+    await record_points_written(data_point.widget_id, widget["dashboard_id"], current_user["user_id"], [data_doc])
     
     return {"message": "Data point added successfully"}
 
 @app.get("/api/data/{widget_id}")
-async def get_widget_data(widget_id: str, current_user = Depends(get_current_user)):
-    # Verify widget access
-    widget = await db.widgets.find_one(
-        {"widget_id": widget_id},
-        {"_id": 0}
-    )
-    if not widget:
-        raise HTTPException(status_code=404, detail="Widget not found")
+async def get_widget_data(
+    widget_id: str,
+    response: Response,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    shape: str = "rows",
+    since: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user = Depends(get_current_user)
+):
+    if shape not in ("rows", "columns"):
+        raise HTTPException(status_code=400, detail="shape must be 'rows' or 'columns'")
+    field_list = parse_fields(fields)
     
-    # Check access (owner or public dashboard)
-    dashboard = await db.dashboards.find_one(
-        {"dashboard_id": widget["dashboard_id"]},
-        {"_id": 0}
-    )
-    if dashboard["owner_id"] != current_user["user_id"] and not dashboard.get("is_public", False):
-        raise HTTPException(status_code=403, detail="Access denied")
+    widget = await get_accessible_widget(widget_id, current_user)
     
-    data_points = await db.data_points.find(
-        {"widget_id": widget_id},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(None)
+    # Unchanged since the client's last read: answer without touching data_points
+    etag = data_etag(widget)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    key = ("data", widget_id, widget.get("data_version", 0), start, end, tuple(field_list or ()), shape, since)
+    try:
+        result = await read_flight.do(key, lambda: fetch_widget_data(widget, start, end, field_list, shape, since=since))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if shape == "columns":
+        # Already JSON-native, so skip FastAPI's per-value encoder walk
+        return JSONResponse(result, headers={"ETag": etag})
     
-    return {"data": data_points}
+    response.headers["ETag"] = etag
+    return result
+
+@app.post("/api/data/query")
+async def query_widget_data(batch: DataQueryBatch, current_user = Depends(get_current_user)):
+    if len(batch.queries) > BATCH_QUERY_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_QUERY_MAX} queries per batch")
+    for query in batch.queries:
+        query.fields = validate_fields(query.fields)
+    
+    # Authorize once per dashboard rather than once per widget
+    loaders = get_loaders()
+    widget_ids = list({q.widget_id for q in batch.queries})
+    widgets = [w for w in await loaders.widgets.load_many(widget_ids) if w]
+    dashboard_ids = list({w["dashboard_id"] for w in widgets})
+    dashboards = [d for d in await loaders.dashboards.load_many(dashboard_ids) if d]
+    allowed_dashboards = {
+        d["dashboard_id"] for d in dashboards
+        if d["owner_id"] == current_user["user_id"] or d.get("is_public", False)
+    }
+    widgets_by_id = {w["widget_id"]: w for w in widgets}
+    
+    semaphore = asyncio.Semaphore(BATCH_QUERY_CONCURRENCY)
+    
+    async def run_query(index: int, query: DataQuery):
+        result = {"index": index, "widget_id": query.widget_id}
+        if query.widget_id not in widgets_by_id:
+            return {**result, "status": 404, "error": "Widget not found"}
+        if widgets_by_id[query.widget_id]["dashboard_id"] not in allowed_dashboards:
+            return {**result, "status": 403, "error": "Access denied"}
+        try:
+            async with semaphore:
+                data = await fetch_widget_data(
+                    widgets_by_id[query.widget_id], query.start, query.end, query.fields,
+                    query.shape, query.aggregate, query.interval, query.since
+                )
+            return {**result, "status": 200, **data}
+        except ValueError as e:
+            return {**result, "status": 400, "error": str(e)}
+        except Exception:
+            # The 200 is already sent, so a failure must stay inside its own entry
+            logger.exception("Batch query failed for widget %s", query.widget_id)
+            return {**result, "status": 500, "error": "Query failed"}
+    
+    tasks = [asyncio.create_task(run_query(i, q)) for i, q in enumerate(batch.queries)]
+    
+    # Results are streamed in completion order; each carries its query index
+    async def stream_results():
+        try:
+            yield '{"results": ['
+            for position, task in enumerate(asyncio.as_completed(tasks)):
+                result = await task
+                yield ("," if position else "") + json.dumps(result, default=json_default)
+            yield "]}"
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/json")
+
+@app.get("/api/data/{widget_id}/derived")
+async def get_widget_derived(
+    widget_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user = Depends(get_current_user)
+):
+    widget = await get_accessible_widget(widget_id, current_user)
+    specs = (widget.get("config") or {}).get("derived") or []
+    if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+        raise HTTPException(status_code=400, detail="config.derived must be a list of objects")
+    
+    data_version = widget.get("data_version", 0)
+    cache_key = (widget_id, data_version, json.dumps(specs, sort_keys=True, default=str), start, end)
+    if cache_key in derived_cache:
+        derived_cache.move_to_end(cache_key)
+        return {"widget_id": widget_id, "data_version": data_version, **derived_cache[cache_key]}
+    
+    try:
+        data_points = await fetch_points(widget, start, end, derived_source_fields(specs))
+        # CPU-bound pandas work, kept off the event loop
+        result = await asyncio.to_thread(evaluate_derived, specs, data_points)
+    except (ValueError, TypeError, RecursionError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid derived config: {str(e)}")
+    
+    derived_cache[cache_key] = result
+    if len(derived_cache) > DERIVED_CACHE_SIZE:
+        derived_cache.popitem(last=False)
+    
+    return {"widget_id": widget_id, "data_version": data_version, **result}
+
+@app.get("/api/data/{widget_id}/summary")
+async def get_widget_summary(
+    widget_id: str,
+    fields: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    quantiles: str = "0.5,0.9",
+    current_user = Depends(get_current_user)
+):
+    try:
+        quantile_list = [float(q) for q in quantiles.split(",") if q.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="quantiles must be comma-separated numbers")
+    if any(q < 0 or q > 1 for q in quantile_list):
+        raise HTTPException(status_code=400, detail="quantiles must be between 0 and 1")
+    field_list = parse_fields(fields)
+    
+    await get_accessible_widget(widget_id, current_user)
+    
+    query = {"widget_id": widget_id}
+    if field_list:
+        query["field"] = {"$in": field_list}
+    if start or end:
+        query["bucket"] = {}
+        if start:
+            query["bucket"]["$gte"] = day_start(start)
+        if end:
+            query["bucket"]["$lt"] = end
+    buckets = await db.widget_sketches.find(query, {"_id": 0, "field": 1, "kll": 1, "hll": 1, "count": 1}).to_list(None)
+    
+    merged = {}
+    for bucket in buckets:
+        kll, hll = KLLSketch.from_bytes(bucket["kll"]), HyperLogLog.from_bytes(bucket["hll"])
+        if bucket["field"] in merged:
+            entry = merged[bucket["field"]]
+            entry["kll"].merge(kll)
+            entry["hll"].merge(hll)
+            entry["count"] += bucket["count"]
+        else:
+            merged[bucket["field"]] = {"kll": kll, "hll": hll, "count": bucket["count"]}
+    
+    summary = {}
+    for field, entry in merged.items():
+        kll = entry["kll"]
+        summary[field] = {
+            "count": entry["count"],
+            "distinct": entry["hll"].count(),
+            "min": kll.min if kll.count else None,
+            "max": kll.max if kll.count else None,
+            "quantiles": {str(q): kll.quantile(q) for q in quantile_list} if kll.count else {}
+        }
+    
+    return {"widget_id": widget_id, "summary": summary}
+
+# CSV fan-out: a mapping of widget_id -> columns splits one parsed upload into
+# per-widget documents built column-wise, optionally timestamped from a column
+def csv_timestamps(df: pd.DataFrame, mapping: CsvWidgetMapping):
+    if not mapping.timestamp_column:
+        return [datetime.utcnow()] * len(df)
+    # Offsets are normalized to UTC, naive values are taken as UTC already
+    parsed = pd.to_datetime(df[mapping.timestamp_column], format=mapping.timestamp_format, errors="coerce", utc=True)
+    if parsed.isna().any():
+        raise ValueError(f"Unparseable timestamps in column '{mapping.timestamp_column}'")
+    parsed = parsed.dt.tz_localize(None)
+    return [ts.to_pydatetime() for ts in parsed]
+
+def csv_widget_points(df: pd.DataFrame, mapping: CsvWidgetMapping, widget: Dict[str, Any], owner_id: str):
+    created_at = datetime.utcnow()
+    records = df[mapping.columns].to_dict("records")
+    return [
+        {
+            "data_id": str(uuid.uuid4()),
+            "dashboard_id": widget["dashboard_id"],
+            "widget_id": widget["widget_id"],
+            "owner_id": owner_id,
+            "data": record,
+            "timestamp": timestamp,
+            "created_at": created_at
+        }
+        for record, timestamp in zip(records, csv_timestamps(df, mapping))
+    ]
+
+async def upload_csv_fan_out(df: pd.DataFrame, file_id: str, mapping: str, dashboard_id: Optional[str], current_user):
+    try:
+        mappings = TypeAdapter(List[CsvWidgetMapping]).validate_json(mapping)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid mapping: {e.errors()[0]['msg']}")
+    if not mappings or len({m.widget_id for m in mappings}) != len(mappings):
+        raise HTTPException(status_code=400, detail="Mapping must list each widget once")
+    
+    widgets = await get_loaders().widgets.load_many([m.widget_id for m in mappings])
+    for m, widget in zip(mappings, widgets):
+        if not widget or widget["owner_id"] != current_user["user_id"]:
+            raise HTTPException(status_code=403, detail=f"Access denied to widget {m.widget_id}")
+        if dashboard_id and widget["dashboard_id"] != dashboard_id:
+            raise HTTPException(status_code=400, detail=f"Widget {m.widget_id} is not on dashboard {dashboard_id}")
+        missing = [c for c in m.columns + [m.timestamp_column] if c and c not in df.columns]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(missing)}")
+    
+    try:
+        batches = [csv_widget_points(df, m, w, current_user["user_id"]) for m, w in zip(mappings, widgets)]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    async def insert_batch(m: CsvWidgetMapping, widget: Dict[str, Any], points: List[Dict[str, Any]]):
+        if not points:
+            return
+        await assign_seq(widget["widget_id"], points)
+        await data_router.insert_many(points)
+        await record_points_written(
+            widget["widget_id"],
+            widget["dashboard_id"],
+            current_user["user_id"],
+            points,
+            totals=numeric_totals(df[m.columns].select_dtypes(include="number").sum().to_dict())
+        )
+    
+    await asyncio.gather(*[insert_batch(m, w, points) for m, w, points in zip(mappings, widgets, batches)])
+    
+    return {
+        "message": f"Successfully processed {len(df)} rows into {len(mappings)} widgets",
+        "file_id": file_id,
+        "widgets": [
+            {
+                "widget_id": m.widget_id,
+                "rows": len(points),
+                "preview": [{k: v for k, v in p.items() if k != "_id"} for p in points[:5]]
+            }
+            for m, points in zip(mappings, batches)
+        ]
+    }
 
 @app.post("/api/upload/csv")
+@write_admission(WRITE_UPLOAD_COST)
 async def upload_csv_data(
     file: UploadFile = File(...),
     dashboard_id: str = None,
     widget_id: str = None,
+    mapping: Optional[str] = Form(None),
     current_user = Depends(get_current_user)
 ):
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Only CSV files are supported")
+    if mapping and widget_id:
+        raise HTTPException(status_code=400, detail="Use either widget_id or mapping, not both")
+    widget = None
+    if widget_id:
+        widget = await get_loaders().widgets.load(widget_id)
+        if not widget or widget["owner_id"] != current_user["user_id"]:
+            raise HTTPException(status_code=403, detail="Access denied")
     
     # Save uploaded file
     file_id = str(uuid.uuid4())
@@ -326,12 +2060,19 @@ async def upload_csv_data(
     # Process CSV
     try:
         df = pd.read_csv(file_path)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error processing CSV: {str(e)}")
+    
+    if mapping:
+        return await upload_csv_fan_out(df, file_id, mapping, dashboard_id, current_user)
+    
+    try:
         data_points = []
         
         for _, row in df.iterrows():
             data_point = {
                 "data_id": str(uuid.uuid4()),
-                "dashboard_id": dashboard_id,
+                "dashboard_id": widget["dashboard_id"] if widget else dashboard_id,
                 "widget_id": widget_id,
                 "owner_id": current_user["user_id"],
                 "data": row.to_dict(),
@@ -340,32 +2081,217 @@ async def upload_csv_data(
             }
             data_points.append(data_point)
         
-        if data_points and dashboard_id and widget_id:
-            await db.data_points.insert_many(data_points)
+        if data_points and widget:
+            await assign_seq(widget_id, data_points)
+            await data_router.insert_many(data_points)
+            await record_points_written(
+                widget_id,
+                widget["dashboard_id"],
+                current_user["user_id"],
+                data_points,
+                totals=numeric_totals(df.select_dtypes(include="number").sum().to_dict())
+            )
         
         return {
             "message": f"Successfully processed {len(data_points)} rows",
             "file_id": file_id,
-            "preview": data_points[:5] if data_points else []
+            "preview": [{k: v for k, v in p.items() if k != "_id"} for p in data_points[:5]]
         }
     
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing CSV: {str(e)}")
 
+# Bulk export: each widget's compacted days then raw points, read from cursors in
+# EXPORT_CHUNK_SIZE batches and encoded chunk by chunk so memory stays flat
+EXPORT_COLUMNS = ["widget_id", "data_id", "timestamp", "compacted"]
+
+async def export_chunks(widgets: List[Dict[str, Any]]):
+    for widget in widgets:
+        widget_id = widget["widget_id"]
+        sources = [
+            (
+                db.data_daily.find({"widget_id": widget_id}, {"_id": 0, "day": 1, "sum": 1, "counts": 1}).sort("day", 1),
+                lambda d: {"widget_id": widget_id, "data_id": None, "timestamp": d["day"], "compacted": True, "data": compacted_means(d)}
+            ),
+            (
+                data_router.route(widget).find({"widget_id": widget_id}, {"_id": 0, "data_id": 1, "timestamp": 1, "data": 1}).sort("timestamp", 1),
+                lambda p: {"widget_id": widget_id, "data_id": p["data_id"], "timestamp": p["timestamp"], "compacted": False, "data": p.get("data", {})}
+            )
+        ]
+        for cursor, to_row in sources:
+            chunk = []
+            async for doc in cursor.batch_size(EXPORT_CHUNK_SIZE):
+                chunk.append(to_row(doc))
+                if len(chunk) >= EXPORT_CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+async def export_fields(widgets: List[Dict[str, Any]]):
+    # BSON types seen per data field, gathered server-side for the CSV header and Parquet schema
+    match = {"$match": {"widget_id": {"$in": [w["widget_id"] for w in widgets]}}}
+    pipeline = [
+        match,
+        {"$project": {"fields": {"$objectToArray": "$data"}}},
+        {"$unwind": "$fields"},
+        {"$group": {"_id": "$fields.k", "types": {"$addToSet": {"$type": "$fields.v"}}}}
+    ]
+    
+    async def partition_fields(collection, group: List[Dict[str, Any]]):
+        partition_match = {"$match": {"widget_id": {"$in": [w["widget_id"] for w in group]}}}
+        return await collection.aggregate([partition_match] + pipeline[1:]).to_list(None)
+    
+    fields = {}
+    for docs in await data_router.scatter_for(widgets, partition_fields):
+        for doc in docs:
+            fields.setdefault(doc["_id"], set()).update(doc["types"])
+    compacted = [match, {"$project": {"fields": {"$objectToArray": "$sum"}}}, {"$unwind": "$fields"}, {"$group": {"_id": "$fields.k"}}]
+    async for doc in db.data_daily.aggregate(compacted):
+        fields.setdefault(doc["_id"], set()).add("double")
+    return dict(sorted(fields.items()))
+
+def export_column(field: str):
+    return f"data.{field}" if field in EXPORT_COLUMNS else field
+
+def export_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+def arrow_type(types: set):
+    types = types - {"null"}
+    if types and types <= {"int", "long"}:
+        return pa.int64()
+    if types and types <= {"int", "long", "double"}:
+        return pa.float64()
+    if types == {"bool"}:
+        return pa.bool_()
+    if types == {"date"}:
+        return pa.timestamp("ms")
+    return pa.string()
+
+async def encode_csv(chunks, fields: Dict[str, set]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS + [export_column(f) for f in fields])
+    async for chunk in chunks:
+        for row in chunk:
+            cells = [row["data"].get(f) for f in fields]
+            writer.writerow(
+                [row["widget_id"], row["data_id"], row["timestamp"].isoformat(), row["compacted"]]
+                + [v if isinstance(v, (int, float, str)) or v is None else export_text(v) for v in cells]
+            )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+async def encode_ndjson(chunks):
+    async for chunk in chunks:
+        yield "".join(json.dumps(row, default=json_default) + "\n" for row in chunk).encode()
+
+class ExportSink:
+    # Write-only file object for ParquetWriter whose bytes are drained after each row group
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+    
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+async def encode_parquet(chunks, fields: Dict[str, set]):
+    types = {field: arrow_type(field_types) for field, field_types in fields.items()}
+    schema = pa.schema(
+        [("widget_id", pa.string()), ("data_id", pa.string()), ("timestamp", pa.timestamp("ms")), ("compacted", pa.bool_())]
+        + [(export_column(field), field_type) for field, field_type in types.items()]
+    )
+    sink = ExportSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    async for chunk in chunks:
+        columns = {column: [row[column] for row in chunk] for column in EXPORT_COLUMNS}
+        for field, field_type in types.items():
+            values = [row["data"].get(field) for row in chunk]
+            columns[export_column(field)] = [export_text(v) for v in values] if field_type == pa.string() else values
+        # One row group per chunk
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+async def gzip_stream(stream):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for data in stream:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+@app.get("/api/dashboards/{dashboard_id}/export")
+async def export_dashboard_data(
+    dashboard_id: str,
+    format: str = "csv",
+    compress: bool = True,
+    current_user = Depends(get_current_user)
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    await get_accessible_dashboard(dashboard_id, current_user)
+    
+    widgets = await db.widgets.find({"dashboard_id": dashboard_id}, {"_id": 0, "widget_id": 1, "owner_id": 1}).sort("created_at", 1).to_list(None)
+    chunks = export_chunks(widgets)
+    
+    if format == "ndjson":
+        stream = encode_ndjson(chunks)
+    elif format == "csv":
+        stream = encode_csv(chunks, await export_fields(widgets))
+    else:
+        stream = encode_parquet(chunks, await export_fields(widgets))
+    
+    filename = f"dashboard-{dashboard_id}.{format}"
+    media_type = EXPORT_FORMATS[format]
+    # Parquet pages are already zstd-compressed
+    if compress and format != "parquet":
+        stream = gzip_stream(stream)
+        filename += ".gz"
+        media_type = "application/gzip"
+    
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @app.get("/api/dashboards/public/discover")
-async def discover_public_dashboards(skip: int = 0, limit: int = 20):
-    dashboards = await db.dashboards.find(
-        {"is_public": True},
-        {"_id": 0, "owner_password": 0}
-    ).skip(skip).limit(limit).to_list(None)
+async def discover_public_dashboards(
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(DISCOVER_PAGE_SIZE, ge=1)
+):
+    dashboards = read_discover_snapshot(skip, limit)
+    if dashboards is not None:
+        response.headers["X-Cache"] = "HIT"
+        response.headers["X-Cache-Age"] = str(int(time.monotonic() - discover_snapshot["built_at"]))
+        return {"dashboards": dashboards}
     
-    # Add owner info
-    for dashboard in dashboards:
-        owner = await db.users.find_one(
-            {"user_id": dashboard["owner_id"]},
-            {"_id": 0, "username": 1, "full_name": 1}
-        )
-        dashboard["owner"] = owner
+    response.headers["X-Cache"] = "MISS"
+    dashboards = await query_public_dashboards(skip, limit)
     
     return {"dashboards": dashboards}
 
@@ -0,0 +1,170 @@
+"""
+Mergeable summary sketches for widget data
+KLLSketch answers approximate quantiles and HyperLogLog approximate distinct
+counts. Both merge losslessly with sketches of the same parameters and
+serialize to compact zlib-compressed bytes for storage in MongoDB.
+"""
+
+import hashlib
+import math
+import random
+import struct
+import zlib
+from typing import Any, Iterable, List, Optional
+
+import numpy as np
+
+
+class KLLSketch:
+    # Karnin-Lang-Liberty quantile sketch: level h holds items of weight 2**h and
+    # a full level promotes every other sorted item to the level above
+    def __init__(self, k: int = 200, c: float = 2 / 3):
+        self.k = k
+        self.c = c
+        self.compactors: List[List[float]] = [[]]
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._update_max_size()
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def _update_max_size(self):
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _size(self) -> int:
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _grow(self):
+        self.compactors.append([])
+        self._update_max_size()
+
+    def _compress(self):
+        for level in range(len(self.compactors)):
+            if len(self.compactors[level]) >= self._capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self._grow()
+                items = sorted(self.compactors[level])
+                # An odd item out stays behind at this level
+                keep = [items.pop()] if len(items) % 2 else []
+                offset = random.randint(0, 1)
+                self.compactors[level + 1].extend(items[offset::2])
+                self.compactors[level] = keep
+                if self._size() < self.max_size:
+                    break
+
+    def update(self, value: float):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if self._size() >= self.max_size:
+            self._compress()
+
+    def update_many(self, values: Iterable[float]):
+        for value in values:
+            self.update(value)
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while self._size() >= self.max_size:
+            self._compress()
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        items = [(item, 2 ** level) for level, compactor in enumerate(self.compactors) for item in compactor]
+        items.sort()
+        total = sum(weight for _, weight in items)
+        target = q * total
+        seen = 0
+        for item, weight in items:
+            seen += weight
+            if seen >= target:
+                return item
+        return items[-1][0]
+
+    def to_bytes(self) -> bytes:
+        header = struct.pack("<IdQddI", self.k, self.c, self.count, self.min, self.max, len(self.compactors))
+        levels = b"".join(
+            struct.pack("<I", len(compactor)) + np.asarray(compactor, dtype="<f8").tobytes()
+            for compactor in self.compactors
+        )
+        return zlib.compress(header + levels)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "KLLSketch":
+        raw = zlib.decompress(data)
+        k, c, count, minimum, maximum, height = struct.unpack_from("<IdQddI", raw)
+        sketch = cls(k, c)
+        sketch.count, sketch.min, sketch.max = count, minimum, maximum
+        offset = struct.calcsize("<IdQddI")
+        sketch.compactors = []
+        for _ in range(height):
+            (length,) = struct.unpack_from("<I", raw, offset)
+            offset += 4
+            sketch.compactors.append(np.frombuffer(raw, dtype="<f8", count=length, offset=offset).tolist())
+            offset += 8 * length
+        sketch._update_max_size()
+        return sketch
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @staticmethod
+    def _hash(value: Any) -> int:
+        return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), "big")
+
+    def update_many(self, values: Iterable[Any]):
+        width = 64 - self.precision
+        mask = (1 << width) - 1
+        index, ranks = [], []
+        for value in values:
+            hashed = self._hash(value)
+            index.append(hashed >> width)
+            # Rank = position of the first set bit in the low 64 - precision bits
+            ranks.append(width - (hashed & mask).bit_length() + 1)
+        if index:
+            np.maximum.at(self.registers, np.array(index), np.array(ranks, dtype=np.uint8))
+
+    def update(self, value: Any):
+        self.update_many([value])
+
+    def merge(self, other: "HyperLogLog"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(struct.pack("<B", self.precision) + self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        raw = zlib.decompress(data)
+        sketch = cls(raw[0])
+        sketch.registers = np.frombuffer(raw, dtype=np.uint8, offset=1).copy()
+        return sketch
@@ -11,6 +11,7 @@ import os
 from pathlib import Path
 import tempfile
 import csv
+import gzip
 
 # Configuration
 BACKEND_URL = "http://localhost:8001"
@@ -63,6 +64,29 @@ class BackendTester:
             self.log_result("Health Check", False, f"Connection failed: {str(e)}")
             return False
     
+    def test_metrics(self):
+        """Test metrics endpoint exposes coalescing, write admission and partition counters"""
+        try:
+            response = self.session.get(f"{API_BASE}/metrics")
+            if response.status_code == 200:
+                single_flight = response.json().get("single_flight", {})
+                write_admission = response.json().get("write_admission", {})
+                partitions = response.json().get("data_partitions", {})
+                if (all(key in single_flight for key in ["executed", "shared", "timeouts", "errors"])
+                        and all(key in write_admission for key in ["admitted", "rate_limited", "overloaded", "in_flight"])
+                        and partitions.get("key") in ("widget_id", "owner_id") and isinstance(partitions.get("points"), list)):
+                    self.log_result("Metrics", True, f"Single-flight saved {single_flight['shared']} queries")
+                    return True
+                else:
+                    self.log_result("Metrics", False, "Missing metric counters", response.json())
+                    return False
+            else:
+                self.log_result("Metrics", False, f"HTTP {response.status_code}", response.text)
+                return False
+        except Exception as e:
+            self.log_result("Metrics", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_user_registration(self):
         """Test user registration endpoint"""
         try:
@@ -282,6 +306,46 @@ class BackendTester:
             self.log_result("Create Public Dashboard", False, f"Request failed: {str(e)}")
             return False
     
+    def test_create_template_dashboard(self):
+        """Test creating a dashboard with template and embedded widgets in one request"""
+        try:
+            dashboard_data = {
+                "title": "Template Fitness Dashboard",
+                "template_type": "fitness",
+                "use_template_widgets": True,
+                "widgets": [
+                    {
+                        "widget_type": "chart",
+                        "title": "Bench Press Weight",
+                        "config": {"type": "line"},
+                        "data": [{"data": {"weight": 135}}, {"data": {"weight": 145}}]
+                    }
+                ]
+            }
+            
+            response = self.session.post(f"{API_BASE}/dashboards", json=dashboard_data)
+            
+            if response.status_code == 200:
+                data = response.json()
+                widget_ids = data.get("widget_ids", [])
+                if "dashboard_id" in data and len(widget_ids) == 6:
+                    points = self.session.get(f"{API_BASE}/data/{widget_ids[-1]}").json().get("data", [])
+                    if len(points) == 2:
+                        self.log_result("Create Template Dashboard", True, f"Created dashboard with {len(widget_ids)} widgets")
+                        return True
+                    self.log_result("Create Template Dashboard", False, f"Expected 2 seed points, got {len(points)}")
+                    return False
+                else:
+                    self.log_result("Create Template Dashboard", False, "Unexpected widgets in response", data)
+                    return False
+            else:
+                self.log_result("Create Template Dashboard", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Create Template Dashboard", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_get_user_dashboards(self):
         """Test retrieving user's dashboards"""
         try:
@@ -346,6 +410,61 @@ class BackendTester:
             self.log_result("Get Specific Dashboard", False, f"Request failed: {str(e)}")
             return False
     
+    def test_follow_dashboard(self):
+        """Test following a dashboard updates its follower counter"""
+        try:
+            if not self.test_dashboard_id:
+                self.log_result("Follow Dashboard", False, "No test dashboard ID available")
+                return False
+                
+            response = self.session.post(f"{API_BASE}/dashboards/{self.test_dashboard_id}/follow")
+            # Following twice must not double count
+            self.session.post(f"{API_BASE}/dashboards/{self.test_dashboard_id}/follow")
+            
+            if response.status_code == 200:
+                dashboard = self.session.get(f"{API_BASE}/dashboards/{self.test_dashboard_id}").json()
+                if dashboard.get("followers_count") == 1 and "followers" not in dashboard:
+                    self.log_result("Follow Dashboard", True, "Follower counted once, no embedded array")
+                    return True
+                else:
+                    self.log_result("Follow Dashboard", False, "Unexpected follower fields", dashboard)
+                    return False
+            else:
+                self.log_result("Follow Dashboard", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Follow Dashboard", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_update_retention(self):
+        """Test setting a dashboard's raw data retention policy"""
+        try:
+            if not self.test_dashboard_id:
+                self.log_result("Update Retention", False, "No test dashboard ID available")
+                return False
+                
+            response = self.session.put(
+                f"{API_BASE}/dashboards/{self.test_dashboard_id}/retention",
+                json={"raw_days": 365, "compact": True}
+            )
+            
+            if response.status_code == 200:
+                dashboard = self.session.get(f"{API_BASE}/dashboards/{self.test_dashboard_id}").json()
+                if dashboard.get("retention", {}).get("raw_days") == 365:
+                    self.log_result("Update Retention", True, "Retention policy stored on dashboard")
+                    return True
+                else:
+                    self.log_result("Update Retention", False, "Retention not stored", dashboard)
+                    return False
+            else:
+                self.log_result("Update Retention", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Update Retention", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_create_widget(self):
         """Test creating a widget for the dashboard"""
         try:
@@ -362,7 +481,11 @@ class BackendTester:
                     "chart_type": "line",
                     "x_axis": "date",
                     "y_axis": "workout_duration",
-                    "color": "#3B82F6"
+                    "color": "#3B82F6",
+                    "derived": [
+                        {"name": "total_calories", "op": "cumulative_sum", "field": "calories", "reduce": "last"},
+                        {"name": "duration_ma", "op": "moving_average", "field": "duration", "window": 2}
+                    ]
                 },
                 "data_source": {"type": "manual"}
             }
@@ -453,6 +576,205 @@ class BackendTester:
             self.log_result("Get Widget Data", False, f"Request failed: {str(e)}")
             return False
     
+    def test_get_widget_data_columns(self):
+        """Test time-range filtered, projected, columnar widget data"""
+        try:
+            if not self.test_widget_id:
+                self.log_result("Get Widget Data (Columns)", False, "No test widget ID available")
+                return False
+                
+            response = self.session.get(
+                f"{API_BASE}/data/{self.test_widget_id}",
+                params={"start": "2000-01-01T00:00:00", "fields": "calories", "shape": "columns"}
+            )
+            
+            if response.status_code == 200:
+                data = response.json().get("data", {})
+                if set(data.keys()) == {"timestamp", "calories"} and len(data["timestamp"]) == len(data["calories"]):
+                    self.log_result("Get Widget Data (Columns)", True, f"Retrieved {len(data['timestamp'])} projected rows")
+                    return True
+                else:
+                    self.log_result("Get Widget Data (Columns)", False, "Unexpected columnar shape", data)
+                    return False
+            else:
+                self.log_result("Get Widget Data (Columns)", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Get Widget Data (Columns)", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_get_widget_derived(self):
+        """Test server-side derived metrics from the widget config"""
+        try:
+            if not self.test_widget_id:
+                self.log_result("Get Widget Derived Metrics", False, "No test widget ID available")
+                return False
+                
+            response = self.session.get(f"{API_BASE}/data/{self.test_widget_id}/derived")
+            
+            if response.status_code == 200:
+                data = response.json()
+                total = data.get("values", {}).get("total_calories")
+                moving_average = data.get("series", {}).get("duration_ma", [])
+                if total == 900 and len(moving_average) == len(data.get("timestamp") or []):
+                    self.log_result("Get Widget Derived Metrics", True, f"Total calories {total}, {len(moving_average)} moving average points")
+                    return True
+                else:
+                    self.log_result("Get Widget Derived Metrics", False, "Unexpected derived values", data)
+                    return False
+            else:
+                self.log_result("Get Widget Derived Metrics", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Get Widget Derived Metrics", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_get_dashboard_latest(self):
+        """Test bulk latest values for all widgets of a dashboard"""
+        try:
+            if not self.test_dashboard_id or not self.test_widget_id:
+                self.log_result("Get Dashboard Latest", False, "Missing widget or dashboard ID")
+                return False
+                
+            response = self.session.get(f"{API_BASE}/dashboards/{self.test_dashboard_id}/latest")
+            
+            if response.status_code == 200:
+                latest = response.json().get("latest", {}).get(self.test_widget_id)
+                if latest and latest.get("count", 0) >= 3 and latest.get("totals", {}).get("calories") == 900:
+                    self.log_result("Get Dashboard Latest", True, f"Latest point tracked over {latest['count']} points")
+                    return True
+                else:
+                    self.log_result("Get Dashboard Latest", False, "Unexpected latest values", response.json())
+                    return False
+            else:
+                self.log_result("Get Dashboard Latest", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Get Dashboard Latest", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_export_dashboard(self):
+        """Test streaming gzip CSV export of all dashboard data"""
+        try:
+            if not self.test_dashboard_id or not self.test_widget_id:
+                self.log_result("Export Dashboard", False, "Missing widget or dashboard ID")
+                return False
+                
+            response = self.session.get(f"{API_BASE}/dashboards/{self.test_dashboard_id}/export", params={"format": "csv"})
+            
+            if response.status_code == 200:
+                lines = gzip.decompress(response.content).decode().splitlines()
+                rows = list(csv.DictReader(lines))
+                widget_rows = [row for row in rows if row["widget_id"] == self.test_widget_id]
+                if len(widget_rows) >= 3 and "calories" in rows[0]:
+                    self.log_result("Export Dashboard", True, f"Exported {len(rows)} rows")
+                    return True
+                else:
+                    self.log_result("Export Dashboard", False, "Unexpected export contents", lines[:5])
+                    return False
+            else:
+                self.log_result("Export Dashboard", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Export Dashboard", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_get_widget_summary(self):
+        """Test sketch-based quantiles and distinct counts for widget fields"""
+        try:
+            if not self.test_widget_id:
+                self.log_result("Get Widget Summary", False, "No test widget ID available")
+                return False
+                
+            response = self.session.get(
+                f"{API_BASE}/data/{self.test_widget_id}/summary",
+                params={"fields": "calories,workout_type", "quantiles": "0.5"}
+            )
+            
+            if response.status_code == 200:
+                summary = response.json().get("summary", {})
+                calories = summary.get("calories", {})
+                workouts = summary.get("workout_type", {})
+                if calories.get("quantiles", {}).get("0.5") == 350 and workouts.get("distinct") == 3:
+                    self.log_result("Get Widget Summary", True, "Median and distinct counts from sketches")
+                    return True
+                else:
+                    self.log_result("Get Widget Summary", False, "Unexpected summary", summary)
+                    return False
+            else:
+                self.log_result("Get Widget Summary", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Get Widget Summary", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_batch_data_query(self):
+        """Test fetching several widget queries in one batch request"""
+        try:
+            if not self.test_widget_id:
+                self.log_result("Batch Data Query", False, "No test widget ID available")
+                return False
+                
+            batch = {
+                "queries": [
+                    {"widget_id": self.test_widget_id, "fields": ["calories"], "shape": "columns"},
+                    {"widget_id": self.test_widget_id, "aggregate": "sum"},
+                    {"widget_id": "nonexistent-widget"}
+                ]
+            }
+            response = self.session.post(f"{API_BASE}/data/query", json=batch)
+            
+            if response.status_code == 200:
+                results = {r["index"]: r for r in response.json().get("results", [])}
+                if (len(results) == 3 and results[0].get("status") == 200
+                        and results[1].get("data", {}).get("calories") == 900
+                        and results[2].get("status") == 404):
+                    self.log_result("Batch Data Query", True, "Batch returned per-query results")
+                    return True
+                else:
+                    self.log_result("Batch Data Query", False, "Unexpected batch results", results)
+                    return False
+            else:
+                self.log_result("Batch Data Query", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Batch Data Query", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_widget_data_delta_sync(self):
+        """Test since-cursor delta sync and 304 for unchanged widget data"""
+        try:
+            if not self.test_widget_id:
+                self.log_result("Widget Data Delta Sync", False, "No test widget ID available")
+                return False
+                
+            response = self.session.get(f"{API_BASE}/data/{self.test_widget_id}")
+            etag = response.headers.get("ETag")
+            cursor = response.json().get("cursor")
+            if response.status_code != 200 or not etag or not cursor:
+                self.log_result("Widget Data Delta Sync", False, "Missing ETag or cursor", response.text)
+                return False
+            
+            unchanged = self.session.get(f"{API_BASE}/data/{self.test_widget_id}", headers={"If-None-Match": etag})
+            delta = self.session.get(f"{API_BASE}/data/{self.test_widget_id}", params={"since": cursor})
+            
+            if unchanged.status_code == 304 and delta.status_code == 200 and delta.json().get("data") == []:
+                self.log_result("Widget Data Delta Sync", True, "Unchanged widget returned 304 and empty delta")
+                return True
+            else:
+                self.log_result("Widget Data Delta Sync", False, f"Got {unchanged.status_code} / {delta.status_code}", delta.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Widget Data Delta Sync", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_discover_public_dashboards(self):
         """Test discovering public dashboards"""
         try:
@@ -486,6 +808,56 @@ class BackendTester:
             self.log_result("Discover Public Dashboards", False, f"Request failed: {str(e)}")
             return False
     
+    def test_discover_snapshot_cache(self):
+        """Test discover feed is served from the snapshot with a cache age header"""
+        try:
+            response = self.session.get(f"{API_BASE}/dashboards/public/discover", params={"skip": 0, "limit": 5})
+            
+            if response.status_code == 200:
+                cache_status = response.headers.get("X-Cache")
+                if cache_status == "HIT" and response.headers.get("X-Cache-Age", "").isdigit():
+                    self.log_result("Discover Snapshot Cache", True, f"Served from snapshot, age {response.headers['X-Cache-Age']}s")
+                    return True
+                elif cache_status == "MISS":
+                    self.log_result("Discover Snapshot Cache", True, "Snapshot not built yet, served from database (acceptable)")
+                    return True
+                else:
+                    self.log_result("Discover Snapshot Cache", False, "Missing cache headers", dict(response.headers))
+                    return False
+            else:
+                self.log_result("Discover Snapshot Cache", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("Discover Snapshot Cache", False, f"Request failed: {str(e)}")
+            return False
+    
+    def test_dashboard_thumbnail(self):
+        """Test public dashboard thumbnails are served with long-lived cache headers"""
+        try:
+            response = self.session.get(f"{API_BASE}/dashboards/public/discover")
+            if response.status_code != 200:
+                self.log_result("Dashboard Thumbnail", False, f"HTTP {response.status_code}", response.text)
+                return False
+            
+            thumbnails = [d["thumbnail_url"] for d in response.json().get("dashboards", []) if d.get("thumbnail_url")]
+            if not thumbnails:
+                self.log_result("Dashboard Thumbnail", True, "No thumbnails rendered yet (acceptable)")
+                return True
+            
+            image = self.session.get(f"{BACKEND_URL}{thumbnails[0]}")
+            cache_control = image.headers.get("Cache-Control", "")
+            if image.status_code == 200 and image.headers.get("content-type", "").startswith("image/") and "immutable" in cache_control:
+                self.log_result("Dashboard Thumbnail", True, f"Thumbnail served ({len(image.content)} bytes, {cache_control})")
+                return True
+            else:
+                self.log_result("Dashboard Thumbnail", False, f"HTTP {image.status_code}", dict(image.headers))
+                return False
+                
+        except Exception as e:
+            self.log_result("Dashboard Thumbnail", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_csv_upload(self):
         """Test CSV file upload functionality"""
         try:
@@ -536,6 +908,41 @@ class BackendTester:
             self.log_result("CSV Upload", False, f"Request failed: {str(e)}")
             return False
     
+    def test_csv_fan_out(self):
+        """Test one CSV upload fanned out to widgets through a column mapping"""
+        try:
+            if not self.test_dashboard_id or not self.test_widget_id:
+                self.log_result("CSV Fan-out", False, "Missing dashboard or widget ID")
+                return False
+            
+            csv_content = "date,exercise,weight\n2024-01-18,Bench Press,135\n2024-01-19,Squats,185\n"
+            mapping = [{"widget_id": self.test_widget_id, "columns": ["weight"], "timestamp_column": "date"}]
+            files = {'file': ('workout_data.csv', csv_content, 'text/csv')}
+            
+            response = self.session.post(
+                f"{API_BASE}/upload/csv",
+                params={"dashboard_id": self.test_dashboard_id},
+                files=files,
+                data={"mapping": json.dumps(mapping)}
+            )
+            
+            if response.status_code == 200:
+                widgets = response.json().get("widgets", [])
+                preview = widgets[0]["preview"] if widgets else []
+                if preview and preview[0]["data"] == {"weight": 135} and preview[0]["timestamp"].startswith("2024-01-18"):
+                    self.log_result("CSV Fan-out", True, f"{widgets[0]['rows']} rows mapped with parsed timestamps")
+                    return True
+                else:
+                    self.log_result("CSV Fan-out", False, "Unexpected projected rows", widgets)
+                    return False
+            else:
+                self.log_result("CSV Fan-out", False, f"HTTP {response.status_code}", response.text)
+                return False
+                
+        except Exception as e:
+            self.log_result("CSV Fan-out", False, f"Request failed: {str(e)}")
+            return False
+    
     def test_invalid_csv_upload(self):
         """Test uploading non-CSV file (should fail)"""
         try:
@@ -565,6 +972,45 @@ class BackendTester:
             self.log_result("Invalid CSV Upload", False, f"Request failed: {str(e)}")
             return False
     
+    def test_write_rate_limit(self):
+        """Test that writes past a user's burst get 429 with Retry-After"""
+        try:
+            # A separate user, so the main test user's bucket is left alone
+            response = requests.post(f"{API_BASE}/auth/register", json={
+                "username": f"burst_{int(time.time())}",
+                "email": f"burst_{int(time.time())}@example.com",
+                "password": "SecurePass123!"
+            })
+            if response.status_code != 200:
+                self.log_result("Write Rate Limit", False, f"Registration HTTP {response.status_code}", response.text)
+                return False
+            
+            session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {response.json()['access_token']}"})
+            # Admission runs before the route, so even a rejected write spends a token
+            for attempt in range(500):
+                response = session.post(f"{API_BASE}/data", json={
+                    "dashboard_id": "missing",
+                    "widget_id": "missing",
+                    "data": {"value": attempt}
+                })
+                if response.status_code == 429:
+                    break
+            
+            if response.status_code != 429:
+                self.log_result("Write Rate Limit", False, f"No 429 after {attempt + 1} writes, last HTTP {response.status_code}")
+                return False
+            if not response.headers.get("Retry-After", "").isdigit():
+                self.log_result("Write Rate Limit", False, "429 without a numeric Retry-After", dict(response.headers))
+                return False
+            
+            self.log_result("Write Rate Limit", True, f"429 after {attempt + 1} writes, Retry-After {response.headers['Retry-After']}s")
+            return True
+                
+        except Exception as e:
+            self.log_result("Write Rate Limit", False, f"Request failed: {str(e)}")
+            return False
+    
     def run_all_tests(self):
         """Run all backend tests in sequence"""
         print("🚀 Starting Comprehensive Backend API Testing")
@@ -573,6 +1019,7 @@ class BackendTester:
         # Test sequence following user journey
         tests = [
             ("API Health Check", self.test_health_check),
+            ("Metrics", self.test_metrics),
             ("User Registration", self.test_user_registration),
             ("Duplicate Registration", self.test_duplicate_registration),
             ("User Login", self.test_user_login),
@@ -581,14 +1028,28 @@ class BackendTester:
             ("Unauthorized Access", self.test_unauthorized_access),
             ("Create Dashboard", self.test_create_dashboard),
             ("Create Public Dashboard", self.test_create_public_dashboard),
+            ("Create Template Dashboard", self.test_create_template_dashboard),
             ("Get User Dashboards", self.test_get_user_dashboards),
             ("Get Specific Dashboard", self.test_get_specific_dashboard),
+            ("Follow Dashboard", self.test_follow_dashboard),
+            ("Update Retention", self.test_update_retention),
             ("Create Widget", self.test_create_widget),
             ("Add Data Points", self.test_add_data_points),
             ("Get Widget Data", self.test_get_widget_data),
+            ("Get Widget Data (Columns)", self.test_get_widget_data_columns),
+            ("Get Widget Derived Metrics", self.test_get_widget_derived),
+            ("Get Dashboard Latest", self.test_get_dashboard_latest),
+            ("Get Widget Summary", self.test_get_widget_summary),
+            ("Batch Data Query", self.test_batch_data_query),
+            ("Widget Data Delta Sync", self.test_widget_data_delta_sync),
+            ("Export Dashboard", self.test_export_dashboard),
             ("Discover Public Dashboards", self.test_discover_public_dashboards),
+            ("Discover Snapshot Cache", self.test_discover_snapshot_cache),
+            ("Dashboard Thumbnail", self.test_dashboard_thumbnail),
             ("CSV Upload", self.test_csv_upload),
-            ("Invalid CSV Upload", self.test_invalid_csv_upload)
+            ("CSV Fan-out", self.test_csv_fan_out),
+            ("Invalid CSV Upload", self.test_invalid_csv_upload),
+            ("Write Rate Limit", self.test_write_rate_limit)
         ]
         
         passed = 0
@@ -85,7 +85,16 @@ const DiscoverPage = () => {
               <div key={dashboard.dashboard_id} className="bg-white rounded-xl shadow-sm border border-gray-200 overflow-hidden hover:shadow-md transition-shadow">
                 {/* Dashboard Preview */}
                 <div className="h-48 bg-gradient-to-br from-blue-50 to-indigo-100 flex items-center justify-center">
-                  <BarChart3 className="h-16 w-16 text-blue-400" />
+                  {dashboard.thumbnail_url ? (
+                    <img
+                      src={`${process.env.REACT_APP_BACKEND_URL}${dashboard.thumbnail_url}`}
+                      alt={dashboard.title}
+                      loading="lazy"
+                      className="h-full w-full object-cover"
+                    />
+                  ) : (
+                    <BarChart3 className="h-16 w-16 text-blue-400" />
+                  )}
                 </div>
 
                 {/* Content */}